@@ -0,0 +1,189 @@
+#
+# Copyright 2013 Philip Tricca <flihp@twobit.us>
+#
+# index of a SINIT ACM library and the search for the ACM behind a TXT
+# heap's SinitHash
+
+import collections
+import hashlib
+import os
+import stat
+import threading
+
+import txt
+
+# one indexed ACM, date is the header's BCD 0xYYYYMMDD
+acmEntry = collections.namedtuple ('acmEntry', ('path', 'chipset', 'date', 'size', 'sha1', 'sha256'))
+# an ACM, SENTER flags and SinitMleData versions reproducing a SinitHash;
+# edx is the flags in hex as pcr17 -e takes them, the four bytes as
+# extended in edx_bytes
+acmMatch = collections.namedtuple ('acmMatch', ('path', 'edx', 'edx_bytes', 'alg', 'smd_versions'))
+
+# SinitMleData versions, the ACM digest they extend depends on the version
+SMD_VERSIONS = (5, 6, 7, 8)
+# ModuleType of chipset ACMs, SINIT among them
+_CHIPSET_MODULE_TYPE = 2
+
+def _smd_alg (smd):
+    # the choice acmParse makes
+    return 'sha256' if smd > 6 else 'sha1'
+
+def _identity (path):
+    _st = os.stat (path)
+    if not stat.S_ISREG (_st.st_mode):
+        return None
+    return (_st.st_dev, _st.st_ino, _st.st_size, int (_st.st_mtime * 1000000000))
+
+def _read_acm (path):
+    ''' acmEntry for the file at path, None when it isn't a SINIT ACM '''
+    with open (path, 'rb') as _fobj:
+        if os.fstat (_fobj.fileno ()).st_size < txt.acmParse._SCRATCH_OFFSET:
+            return None
+        _acm = txt.acmParse (_fobj, True)
+        if _acm.ModuleType () != _CHIPSET_MODULE_TYPE:
+            return None
+        _digests = _acm.Digests ()
+        return acmEntry (path, _acm.ChipsetID (), _acm.Date (), _acm._file_size, _digests ['sha1'], _digests ['sha256'])
+
+def sinit_hash (digest, edx_bytes):
+    # PCR[17] from reset extended with sha1 (digest | edx_bytes)
+    return hashlib.sha1 ('\x00' * 20 + hashlib.sha1 (digest + edx_bytes).digest ()).digest ()
+
+def edx_candidates (heap_flags=None, edx=()):
+    ''' (label, four bytes) for the heap's EdxSenterFlags, 0 and each value
+    in edx, the label is what to pass pcr17 -e '''
+    _values = ['{0:#x}'.format (heap_flags)] if heap_flags is not None else []
+    _candidates = collections.OrderedDict ()
+    for _index, _value in enumerate (_values + ['0x0'] + list (edx)):
+        try:
+            _bytes = txt.senter_flags (_value)
+        except TypeError:
+            # flags from the heap pcr17 -e can't express aren't worth trying
+            if _index >= len (_values):
+                raise
+            continue
+        _candidates.setdefault (_bytes, str (_value))
+    return [(_label, _bytes) for _bytes, _label in _candidates.iteritems ()]
+
+def match_entries (entries, target, edx, smd_versions=SMD_VERSIONS):
+    _algs = collections.OrderedDict ()
+    for _smd in smd_versions:
+        _algs.setdefault (_smd_alg (_smd), []).append (_smd)
+    _matches = []
+    for _entry in entries:
+        for _alg, _versions in _algs.iteritems ():
+            _digest = getattr (_entry, _alg)
+            for _label, _bytes in edx:
+                if sinit_hash (_digest, _bytes) == target:
+                    _matches.append (acmMatch (_entry.path, _label, _bytes, _alg, tuple (_versions)))
+    return _matches
+
+class acmLibrary (object):
+    ''' sqlite index of the SINIT ACMs in a directory, with both digests '''
+    _SCHEMA = (
+        '''CREATE TABLE IF NOT EXISTS acms (
+            path TEXT PRIMARY KEY, dev INTEGER, ino INTEGER, size INTEGER, mtime_ns INTEGER,
+            chipset INTEGER, date INTEGER, module_size INTEGER, sha1 BLOB, sha256 BLOB)''',
+        '''CREATE INDEX IF NOT EXISTS acms_chipset_date
+            ON acms (chipset, date)''',
+        '''CREATE TABLE IF NOT EXISTS skipped (
+            path TEXT PRIMARY KEY, dev INTEGER, ino INTEGER, size INTEGER, mtime_ns INTEGER)''',
+        )
+    def __init__ (self, path):
+        import sqlite3
+        self._db = sqlite3.connect (path, timeout=60, check_same_thread=False)
+        self._lock = threading.Lock ()
+        for _stmt in self._SCHEMA:
+            self._db.execute (_stmt)
+        self._db.commit ()
+    def scan (self, directory, jobs=1):
+        ''' returns (number of files read, {path: error}) '''
+        _directory = os.path.realpath (directory)
+        with self._lock:
+            _known = dict ((str (_row [0]), tuple (_row [1:])) for _table in ('acms', 'skipped')
+                           for _row in self._db.execute ('SELECT path, dev, ino, size, mtime_ns FROM ' + _table))
+        _present = dict ()
+        _errors = dict ()
+        for _name in sorted (os.listdir (_directory)):
+            if _name.startswith ('.'):
+                continue
+            _path = os.path.join (_directory, _name)
+            try:
+                _ident = _identity (_path)
+            except OSError as e:
+                _errors [_path] = e.strerror
+                continue
+            if _ident is not None:
+                _present [_path] = _ident
+        _changed = [_path for _path, _ident in _present.iteritems () if _known.get (_path) != _ident]
+        def _load (path):
+            try:
+                return path, _read_acm (path), None
+            except (EnvironmentError, ValueError) as e:
+                return path, None, getattr (e, 'strerror', None) or str (e)
+        if jobs > 1 and len (_changed) > 1:
+            import multiprocessing.pool
+            _pool = multiprocessing.pool.ThreadPool (jobs)
+            try:
+                _loaded = _pool.map (_load, _changed)
+            finally:
+                _pool.close ()
+                _pool.join ()
+        else:
+            _loaded = map (_load, _changed)
+        _gone = [_path for _path in _known if _path.startswith (_directory + os.sep) and _path not in _present]
+        with self._lock:
+            with self._db:
+                for _table in ('acms', 'skipped'):
+                    self._db.executemany ('DELETE FROM {0} WHERE path = ?'.format (_table),
+                                          ((_path,) for _path in _gone + _changed))
+                for _path, _entry, _error in _loaded:
+                    if _error is not None:
+                        _errors [_path] = _error
+                    elif _entry is None:
+                        self._db.execute ('INSERT INTO skipped VALUES (?, ?, ?, ?, ?)', (_path,) + _present [_path])
+                    else:
+                        self._db.execute ('INSERT INTO acms VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                          (_path,) + _present [_path] + (_entry.chipset, _entry.date, _entry.size,
+                                                                         buffer (_entry.sha1), buffer (_entry.sha256)))
+        return len (_changed), _errors
+    def entries (self, chipset=None, since=None, until=None):
+        _query = 'SELECT path, chipset, date, module_size, sha1, sha256 FROM acms'
+        _where = []
+        _params = ()
+        for _clause, _value in (('chipset = ?', chipset), ('date >= ?', since), ('date <= ?', until)):
+            if _value is not None:
+                _where.append (_clause)
+                _params += (_value,)
+        if _where:
+            _query += ' WHERE ' + ' AND '.join (_where)
+        with self._lock:
+            _rows = self._db.execute (_query + ' ORDER BY date DESC, path', _params).fetchall ()
+        return [acmEntry (str (_path), _chipset, _date, _size, str (_sha1), str (_sha256))
+                for _path, _chipset, _date, _size, _sha1, _sha256 in _rows]
+    def search (self, target, edx, smd_versions=SMD_VERSIONS, chipset=None, since=None, until=None, jobs=1):
+        _entries = self.entries (chipset, since, until)
+        if jobs <= 1 or len (_entries) < 2:
+            return match_entries (_entries, target, edx, smd_versions)
+        _chunks = [_entries [_index::jobs] for _index in xrange (jobs)]
+        import multiprocessing.pool
+        _pool = multiprocessing.pool.ThreadPool (jobs)
+        try:
+            _results = _pool.map (lambda _chunk: match_entries (_chunk, target, edx, smd_versions), _chunks)
+        finally:
+            _pool.close ()
+            _pool.join ()
+        _matches = [_match for _result in _results for _match in _result]
+        _order = dict ((_entry.path, _index) for _index, _entry in enumerate (_entries))
+        return sorted (_matches, key=lambda _match: _order [_match.path])
+    def __len__ (self):
+        with self._lock:
+            return self._db.execute ('SELECT COUNT (*) FROM acms').fetchone () [0]
+    def close (self):
+        self._db.close ()
+
+def open_library (directory, index=None, jobs=1):
+    ''' returns (library, {path: error}) '''
+    _library = acmLibrary (index or os.path.join (directory, '.acm-index'))
+    _count, _errors = _library.scan (directory, jobs)
+    return _library, _errors
@@ -0,0 +1,178 @@
+#
+# Copyright 2013 Philip Tricca <flihp@twobit.us>
+#
+# SinitMleData and OsSinitData from many TXT heaps decoded in bulk into
+# NumPy structured arrays, needs numpy
+
+import collections
+import mmap
+import os
+
+import numpy
+
+import txt
+
+# where one decoded heap came from: a file and the offset of the heap or
+# snapshot in it
+heapSource = collections.namedtuple ('heapSource', ('path', 'offset'))
+
+def layout_dtype (layout):
+    # byte for byte like the recordLayout, byte fields are 'S' so they
+    # compare and sort as strings
+    _names = layout.fields ()
+    _formats = []
+    for _name in _names:
+        if layout.kind [_name] == txt.FIELD_UINT:
+            _formats.append ('<u{0}'.format (layout.width [_name]))
+        else:
+            _formats.append ('S{0}'.format (layout.width [_name]))
+    return numpy.dtype ({'names' : _names, 'formats' : _formats,
+                         'offsets' : [layout.offset [_name] for _name in _names], 'itemsize' : layout.size})
+
+def _heap_sections (data, offset, end):
+    # txtHeap's section walk over a map, offsets absolute in data
+    _sections = []
+    _pos = offset
+    for _name, _size_length in txt.txtHeap._SECTIONS:
+        if _pos + _size_length > end:
+            raise IOError ('TXT heap {0} size field at offset {1:#x} is past the end'.format (_name, _pos))
+        _size = txt._UINT_STRUCT [_size_length].unpack_from (data, _pos) [0]
+        if _size < _size_length or _pos + _size > end:
+            raise IOError ('TXT heap {0} of size {1:#x} at offset {2:#x} does not fit'.format (_name, _size, _pos))
+        _sections.append (txt.heapSection (_pos + _size_length, _size - _size_length))
+        _pos += _size
+    return _sections
+
+def _snapshot_sections (data, offset, end):
+    # (sections, end of the snapshot) for the heapSnapshot at offset
+    if offset + txt.heapSnapshot.HEADER_SIZE > end:
+        raise IOError ('TXT heap snapshot header at offset {0:#x} is past the end'.format (offset))
+    _header = buffer (data, offset, txt.heapSnapshot.HEADER_SIZE)
+    _rec = txt.heapSnapshot._LAYOUT.unpack_from (_header)
+    if _rec.FormatVersion != txt.heapSnapshot._FORMAT_VERSION:
+        raise IOError ('unsupported TXT heap snapshot version {0}'.format (_rec.FormatVersion))
+    _heap = offset + _rec.HeapOffset
+    if _heap + _rec.HeapLength > end:
+        raise IOError ('TXT heap snapshot at offset {0:#x} is truncated'.format (offset))
+    _table = txt.heapSnapshot._ParseTable (_header, min (_rec.NumSections, txt.heapSnapshot._NUM_SECTIONS))
+    return [txt.heapSection (_heap + _offset, _length) for _offset, _length in _table], _heap + _rec.HeapLength
+
+def _walk (data, size, archive):
+    # (offset, sections, end) of the heap in a file, or of each heap and
+    # snapshot stored back to back in an archive
+    _offset = 0
+    while _offset < size:
+        if data [_offset:_offset + len (txt.heapSnapshot.MAGIC)] == txt.heapSnapshot.MAGIC:
+            _sections, _end = _snapshot_sections (data, _offset, size)
+        else:
+            _sections = _heap_sections (data, _offset, size)
+            _end = _sections [-1].offset + _sections [-1].length
+        yield _offset, _sections, _end
+        if not archive:
+            return
+        _offset = _end
+
+class tableArrays (object):
+    ''' records [version] holds a table's rows for that version, heaps
+    [version] the index of the heap each row came from '''
+    def __init__ (self, layouts, count):
+        self._layouts = layouts
+        self._count = count
+        self.records = dict ()
+        self.heaps = dict ()
+    def versions (self):
+        return sorted (self.records)
+    def dtype (self, version):
+        return layout_dtype (txt._versioned_layout (self._layouts, version))
+    def fields (self):
+        return layout_dtype (self._layouts [max (self._layouts)]).names
+    def column (self, name):
+        # one entry per heap, masked where its table doesn't have the field
+        _dtype = layout_dtype (self._layouts [max (self._layouts)]).fields [name][0]
+        _column = numpy.ma.masked_all (self._count, _dtype)
+        for _version, _records in self.records.iteritems ():
+            if name in _records.dtype.names:
+                _column [self.heaps [_version]] = _records [name]
+        return _column
+
+class heapArrays (object):
+    def __init__ (self, sources, errors, sinit_mle, os_sinit):
+        self.sources = sources
+        self.errors = errors
+        self.sinit_mle = sinit_mle
+        self.os_sinit = os_sinit
+    def __len__ (self):
+        return len (self.sources)
+
+class _tableCollector (object):
+    # raw table bytes gathered per version and decoded with one
+    # numpy.frombuffer call per version
+    def __init__ (self, cls):
+        self._cls = cls
+        self._chunks = collections.defaultdict (list)
+        self._heaps = collections.defaultdict (list)
+    def read (self, data, section):
+        if section.length < self._cls._VERSION_LENGTH:
+            raise IOError ('{0} too short for its version'.format (self._cls.__name__))
+        _version = txt._UINT_STRUCT [self._cls._VERSION_LENGTH].unpack_from (data, section.offset + self._cls._VERSION_OFFSET) [0]
+        _size = txt._versioned_layout (self._cls._LAYOUTS, _version).size
+        if section.length < _size:
+            raise IOError ('{0} version {1} too short: {2:#x} bytes'.format (self._cls.__name__, _version, section.length))
+        return _version, data [section.offset:section.offset + _size]
+    def append (self, index, version, chunk):
+        self._chunks [version].append (chunk)
+        self._heaps [version].append (index)
+    def arrays (self, count):
+        _arrays = tableArrays (self._cls._LAYOUTS, count)
+        for _version, _chunks in self._chunks.iteritems ():
+            _arrays.records [_version] = numpy.frombuffer (''.join (_chunks), _arrays.dtype (_version))
+            _arrays.heaps [_version] = numpy.array (self._heaps [_version], numpy.uint32)
+        return _arrays
+
+def _files (paths):
+    for _path in paths:
+        if os.path.isdir (_path):
+            for _name in sorted (os.listdir (_path)):
+                if os.path.isfile (os.path.join (_path, _name)):
+                    yield os.path.join (_path, _name)
+        else:
+            yield _path
+
+def load (paths=(), archives=()):
+    ''' heaps and snapshots in paths (files or directories) and in
+    archives (files of them back to back), snapshot checksums aren't
+    verified '''
+    _sinit_mle = _tableCollector (txt.sinitMleData)
+    _os_sinit = _tableCollector (txt.osSinitData)
+    _sources = []
+    _errors = []
+    for _path, _archive in [(_p, False) for _p in _files (paths)] + [(_p, True) for _p in archives]:
+        try:
+            _fobj = open (_path, 'rb')
+        except IOError as e:
+            _errors.append ((heapSource (_path, 0), str (e.strerror)))
+            continue
+        with _fobj:
+            _size = os.fstat (_fobj.fileno ()).st_size
+            if not _size:
+                _errors.append ((heapSource (_path, 0), 'empty file'))
+                continue
+            _data = mmap.mmap (_fobj.fileno (), _size, access=mmap.ACCESS_READ)
+            _next = 0
+            try:
+                for _offset, _sections, _next in _walk (_data, _size, _archive):
+                    try:
+                        _tables = (_sinit_mle.read (_data, _sections [txt.txtHeap._SINIT_MLE_DATA_INDEX]),
+                                   _os_sinit.read (_data, _sections [txt.txtHeap._OS_SINIT_DATA_INDEX]))
+                    except IOError as e:
+                        _errors.append ((heapSource (_path, _offset), str (e)))
+                        continue
+                    _sinit_mle.append (len (_sources), *_tables [0])
+                    _os_sinit.append (len (_sources), *_tables [1])
+                    _sources.append (heapSource (_path, _offset))
+            except IOError as e:
+                # nothing past a heap whose size fields are broken can be found
+                _errors.append ((heapSource (_path, _next), str (e)))
+            finally:
+                _data.close ()
+    return heapArrays (_sources, _errors, _sinit_mle.arrays (len (_sources)), _os_sinit.arrays (len (_sources)))
@@ -0,0 +1,189 @@
+#
+# Copyright 2013 Philip Tricca <flihp@twobit.us>
+#
+# index of the PCR values approved configurations are predicted to give
+
+import collections
+import json
+import os
+import sqlite3
+import threading
+
+import txt
+
+# one configuration predicted to give the value looked up, extends is a
+# list of (name, value) pairs in extend order
+goldenMatch = collections.namedtuple ('goldenMatch', ('name', 'pcr', 'alg', 'extends'))
+
+def _error_str (e):
+    if isinstance (e, EnvironmentError) and e.strerror:
+        return '{0}: {1}'.format (e.filename, e.strerror) if e.filename else e.strerror
+    return str (getattr (e, 'message', None) or e)
+
+def _read_cmdline (path):
+    with open (path, 'r') as _fobj:
+        return _fobj.readline ()
+
+_FILE_FIELDS = ('acm', 'heap', 'lcp', 'mle')
+
+def resolve (host, base_dir=''):
+    def _path (name):
+        return os.path.realpath (os.path.join (base_dir, name))
+    _host = dict (host)
+    for _field in _FILE_FIELDS:
+        if _host.get (_field):
+            _host [_field] = _path (_host [_field])
+    _host ['modules'] = [[_path (_cmdline), _path (_module)] for _cmdline, _module in host ['modules']]
+    return _host
+
+def host_paths (host):
+    _paths = set (host [_field] for _field in _FILE_FIELDS if host.get (_field))
+    for _pair in host ['modules']:
+        _paths.update (_pair)
+    return _paths
+
+def _pcr17 (host, banks, cache):
+    if not host.get ('acm') or not host.get ('heap'):
+        return None
+    # pcr17 and pcr-batch don't predict PCR[17] without the LCP either
+    if not host.get ('lcp'):
+        raise ValueError ('no lcp given')
+    _files = []
+    try:
+        for _field in ('acm', 'heap', 'lcp'):
+            _files.append (open (host [_field], 'rb'))
+        _result = txt.compute_pcr17 (_files [0], _files [1], _files [2],
+                                     host ['edx'], host ['smd'], banks, cache)
+    finally:
+        for _fobj in _files:
+            _fobj.close ()
+    if not _result.sinit_hash_matches:
+        raise ValueError ('ACM hash does not match SinitHash from the TXT heap')
+    return _result
+
+def _pcr18 (host, banks, cache):
+    if not host.get ('mle') or not host ['modules']:
+        return None
+    _cmdline, _module = host ['modules'][0]
+    with open (host ['mle'], 'rb') as _mle:
+        with open (_module, 'rb') as _fobj:
+            return txt.compute_pcr18 (_mle, host.get ('mle_args') or '', _read_cmdline (_cmdline),
+                                      _fobj, banks, cache)
+
+def _pcr19 (host, banks, cache):
+    _modules = txt.policy_modules (txt.read_policy (host.get ('lcp')), host ['modules'], 19)
+    if not _modules:
+        return None
+    _files = []
+    try:
+        for _cmdline, _module in _modules:
+            _files.append ((_read_cmdline (_cmdline), open (_module, 'rb')))
+        return txt.compute_pcr19 (_files, banks, cache)
+    finally:
+        for _cmdline, _fobj in _files:
+            _fobj.close ()
+
+def predict (host, banks=('sha1',), cache=None):
+    ''' ({pcr: pcrResult}, {pcr: error}) for a host with absolute paths '''
+    _results = dict ()
+    _errors = dict ()
+    for _index, _func in ((17, _pcr17), (18, _pcr18), (19, _pcr19)):
+        try:
+            _result = _func (host, banks, cache)
+        except Exception as e:
+            # anything one host's bad input throws is that PCR's error, as
+            # in pcr-batch, so it can't sink the rest of the manifest
+            _errors [_index] = _error_str (e)
+            continue
+        if _result is not None:
+            _results [_index] = _result
+    return _results, _errors
+
+class goldenIndex (object):
+    ''' sqlite index from predicted PCR values to the manifest hosts
+    giving them, and from each file to the hosts that read it '''
+    _SCHEMA = (
+        '''CREATE TABLE IF NOT EXISTS configs (
+            name TEXT PRIMARY KEY, host TEXT, banks TEXT)''',
+        '''CREATE TABLE IF NOT EXISTS predictions (
+            name TEXT, pcr INTEGER, alg TEXT, value BLOB, extends TEXT,
+            PRIMARY KEY (name, pcr, alg))''',
+        '''CREATE INDEX IF NOT EXISTS predictions_value
+            ON predictions (value)''',
+        '''CREATE TABLE IF NOT EXISTS artifacts (
+            path TEXT, name TEXT, PRIMARY KEY (path, name))''',
+        '''CREATE INDEX IF NOT EXISTS artifacts_name
+            ON artifacts (name)''',
+        )
+    def __init__ (self, path):
+        self._db = sqlite3.connect (path, timeout=60, check_same_thread=False)
+        self._lock = threading.Lock ()
+        for _stmt in self._SCHEMA:
+            self._db.execute (_stmt)
+        self._db.commit ()
+    def _delete (self, names):
+        for _table in ('configs', 'predictions', 'artifacts'):
+            self._db.executemany ('DELETE FROM {0} WHERE name = ?'.format (_table), ((_name,) for _name in names))
+    def add (self, hosts, banks=('sha1',), cache=None):
+        ''' returns {name: {pcr: error}} for the PCRs that failed '''
+        _configs = []
+        _predictions = []
+        _artifacts = []
+        _failed = dict ()
+        for _host in hosts:
+            _name = str (_host ['host'])
+            _results, _errors = predict (_host, banks, cache)
+            if _errors:
+                _failed [_name] = _errors
+            _configs.append ((_name, json.dumps (_host, sort_keys=True), ','.join (banks)))
+            for _index, _result in _results.iteritems ():
+                for _alg in _result.pcr.algs ():
+                    _extends = [(_extend.name, _extend.values [_alg].encode ('hex')) for _extend in _result.extends]
+                    _predictions.append ((_name, _index, _alg, buffer (_result.pcr.read (_alg)), json.dumps (_extends)))
+            _artifacts.extend ((_path, _name) for _path in host_paths (_host))
+        with self._lock:
+            with self._db:
+                self._delete ([_config [0] for _config in _configs])
+                self._db.executemany ('INSERT INTO configs VALUES (?, ?, ?)', _configs)
+                self._db.executemany ('INSERT INTO predictions VALUES (?, ?, ?, ?, ?)', _predictions)
+                self._db.executemany ('INSERT INTO artifacts VALUES (?, ?)', _artifacts)
+        return _failed
+    def users (self, path):
+        with self._lock:
+            _rows = self._db.execute ('SELECT name FROM artifacts WHERE path = ? ORDER BY name',
+                                      (os.path.realpath (path),)).fetchall ()
+        return [_row [0] for _row in _rows]
+    def retire (self, path):
+        _names = self.users (path)
+        with self._lock:
+            with self._db:
+                self._delete (_names)
+        return _names
+    def refresh (self, path, cache=None):
+        ''' returns (names, {name: {pcr: error}}) '''
+        _names = self.users (path)
+        with self._lock:
+            _rows = [self._db.execute ('SELECT host, banks FROM configs WHERE name = ?', (_name,)).fetchone ()
+                     for _name in _names]
+        _by_banks = collections.defaultdict (list)
+        for _host, _banks in _rows:
+            _by_banks [tuple (str (_alg) for _alg in _banks.split (','))].append (json.loads (_host))
+        _failed = dict ()
+        for _banks, _hosts in _by_banks.iteritems ():
+            _failed.update (self.add (_hosts, _banks, cache))
+        return _names, _failed
+    def lookup (self, value, pcr=None):
+        _query = 'SELECT name, pcr, alg, extends FROM predictions WHERE value = ?'
+        _params = (buffer (value),)
+        if pcr is not None:
+            _query += ' AND pcr = ?'
+            _params += (pcr,)
+        with self._lock:
+            _rows = self._db.execute (_query + ' ORDER BY name, pcr', _params).fetchall ()
+        return [goldenMatch (str (_name), _pcr, str (_alg), [tuple (str (_item) for _item in _extend) for _extend in json.loads (_extends)])
+                for _name, _pcr, _alg, _extends in _rows]
+    def __len__ (self):
+        with self._lock:
+            return self._db.execute ('SELECT COUNT (*) FROM configs').fetchone () [0]
+    def close (self):
+        self._db.close ()
@@ -0,0 +1,334 @@
+#
+# Copyright 2013 Philip Tricca <flihp@twobit.us>
+#
+# long running PCR calculation service and its client
+
+import collections
+import errno
+import os
+import stat
+import struct
+import sys
+import threading
+
+import txt
+
+ENV_VAR = 'PCR_CALC_SOCKET'
+
+def _default_socket ():
+    # in the per-user runtime directory, or in a 0700 directory of our own
+    # under /tmp, never straight in a directory anyone can write to
+    _runtime = os.environ.get ('XDG_RUNTIME_DIR')
+    if _runtime:
+        return os.path.join (_runtime, 'pcr-calc.sock')
+    return os.path.join ('/tmp', 'pcr-calc-{0}'.format (os.getuid ()), 'pcrd.sock')
+
+DEFAULT_SOCKET = _default_socket ()
+
+# struct ucred from Linux for SO_PEERCRED
+_UCRED = struct.Struct ('3i')
+
+class daemonError (Exception):
+    def __init__ (self, message):
+        self.message = message
+    def __str__ (self):
+        return self.message
+
+class lruCache (object):
+    ''' Bounded map that drops the least recently used entry when full.
+    get () loads missing keys through loader outside the lock, so a slow
+    load doesn't hold up other threads. '''
+    def __init__ (self, max_entries):
+        self._max_entries = max_entries
+        self._entries = collections.OrderedDict ()
+        self._lock = threading.Lock ()
+    def __len__ (self):
+        return len (self._entries)
+    def get (self, key, loader):
+        with self._lock:
+            if key in self._entries:
+                _value = self._entries.pop (key)
+                self._entries [key] = _value
+                return _value
+        _value = loader ()
+        with self._lock:
+            self._entries [key] = _value
+            while len (self._entries) > self._max_entries:
+                self._entries.popitem (last=False)
+        return _value
+
+def _identity (path):
+    # the same (device, inode, size, mtime) the measurement cache keys on
+    _st = os.stat (path)
+    return (_st.st_dev, _st.st_ino, _st.st_size, int (_st.st_mtime * 1e9))
+
+def _hex (value):
+    if isinstance (value, dict):
+        return dict ((_key, _hex (_value)) for _key, _value in value.iteritems ())
+    return str (value).encode ('hex')
+
+def _unhex (value):
+    if isinstance (value, dict):
+        return dict ((str (_key), _unhex (_value)) for _key, _value in value.iteritems ())
+    return str (value).decode ('hex')
+
+def result_to_json (result):
+    return {'index' : result.index,
+            'banks' : list (result.pcr.algs ()),
+            'sinit_hash_matches' : result.sinit_hash_matches,
+            'extends' : [{'name' : _extend.name,
+                          'values' : _hex (_extend.values),
+                          'parts' : [[_name, _hex (_part)] for _name, _part in (_extend.parts or {}).iteritems ()]}
+                         for _extend in result.extends]}
+
+def result_from_json (obj):
+    ''' Rebuild a pcrResult, the pcrEmu is replayed from the extends. '''
+    _extends = [txt.pcrExtend (_extend ['name'], _unhex (_extend ['values']),
+                               collections.OrderedDict ((str (_name), _unhex (_part)) for _name, _part in _extend ['parts']))
+                for _extend in obj ['extends']]
+    _pcr = txt.pcrEmu ([str (_alg) for _alg in obj ['banks']])
+    _pcr.extend_many (_extend.values for _extend in _extends)
+    return txt.pcrResult (obj ['index'], _pcr, _extends, obj ['sinit_hash_matches'])
+
+class warmStore (object):
+    ''' What the daemon keeps between requests: parsed ACMs with their
+    digests, loaded MLE images with their per cmdline hashes and module
+    digests, each in an LRU keyed by file identity so a replaced file is
+    never served stale. '''
+    def __init__ (self, max_entries=256, cache=None):
+        self._acms = lruCache (max_entries)
+        self._mles = lruCache (max_entries)
+        self._modules = lruCache (max_entries * 16)
+        self._cache = cache
+    def acm (self, path, smd):
+        return self._acms.get ((_identity (path), smd),
+                               lambda: txt.acmParse (open (path, 'rb'), True, smd, self._cache))
+    def mle (self, path, cmdline, banks):
+        # one MLE header per file, it memoizes the hashes of its last few cmdlines
+        _hdr = self._mles.get (_identity (path), lambda: txt.MLEUtil (None, open (path, 'rb')).get_mle_hdr ())
+        return dict ((_alg, _hash.digest ()) for _alg, _hash in _hdr.hashes (banks, cmdline).iteritems ())
+    def module (self, cmdline, path, banks):
+        _key = (_identity (path), cmdline, tuple (banks))
+        def _load ():
+            with open (path, 'rb') as _fobj:
+                _hashes = txt.hash_module_banks (cmdline, _fobj, banks, self._cache)
+                return dict ((_alg, _hash.digest ()) for _alg, _hash in _hashes.iteritems ())
+        return self._modules.get (_key, _load)
+
+    def _pcr17 (self, request, banks):
+        _smd = int (request.get ('smd', 8))
+        with open (request ['heap'], 'rb') as _heap:
+            _lcp = open (request ['lcp'], 'rb') if request.get ('lcp') else None
+            try:
+                _result = txt.compute_pcr17 (self.acm (request ['acm'], _smd), _heap, _lcp,
+                                             request.get ('edx', 0), _smd, banks, use_mmap=True)
+            finally:
+                if _lcp is not None:
+                    _lcp.close ()
+        return result_to_json (_result)
+    def _mle_extend (self, request, banks):
+        return txt.pcrExtend ('mle', self.mle (request ['mle'], request.get ('mle_args') or '', banks), None)
+    def _module_extend (self, module, banks):
+        return txt.pcrExtend (module [1], self.module (module [0], module [1], banks), None)
+    def _pcr18 (self, request, banks):
+        _extends = [self._mle_extend (request, banks), self._module_extend (request ['module'], banks)]
+        _pcr = txt.pcrEmu (banks)
+        _pcr.extend_many (_extend.values for _extend in _extends)
+        return result_to_json (txt.pcrResult (18, _pcr, _extends, None))
+    def _pcr19 (self, request, banks):
+        _extends = [self._module_extend (_module, banks) for _module in request ['modules']]
+        _pcr = txt.pcrEmu (banks)
+        _pcr.extend_many (_extend.values for _extend in _extends)
+        return result_to_json (txt.pcrResult (19, _pcr, _extends, None))
+    def _mlehash (self, request, banks):
+        return {'hashes' : _hex (self._mle_extend (request, banks).values)}
+    def _ping (self, request, banks):
+        return {'acms' : len (self._acms), 'mles' : len (self._mles), 'modules' : len (self._modules)}
+
+    def handle (self, request):
+        ''' Answer one decoded request, failures become {"ok": false}. '''
+        try:
+            _op = getattr (self, '_' + str (request ['op']), None)
+            if _op is None:
+                raise daemonError ('unknown op: {0}'.format (request ['op']))
+            _response = _op (request, tuple (str (_alg) for _alg in request.get ('banks', ('sha1',))))
+            _response ['ok'] = True
+        except Exception as e:
+            # whatever one bad request raises goes back to its client only
+            _response = {'ok' : False, 'error' : str (getattr (e, 'message', None) or e),
+                         'error_type' : type (e).__name__}
+        return _response
+
+def _serve_connection (conn, store):
+    # one JSON request per line, answered with one JSON line
+    import json
+    _file = conn.makefile ('rwb')
+    try:
+        for _line in iter (_file.readline, ''):
+            try:
+                _request = json.loads (_line)
+            except ValueError as e:
+                _response = {'ok' : False, 'error' : 'bad request: {0}'.format (e), 'error_type' : 'ValueError'}
+            else:
+                _response = store.handle (_request)
+            _file.write (json.dumps (_response) + '\n')
+            _file.flush ()
+    finally:
+        _file.close ()
+
+def _is_socket (path):
+    try:
+        return stat.S_ISSOCK (os.lstat (path).st_mode)
+    except OSError:
+        return False
+
+def _private_dir (path):
+    # create the directory for the default socket, or make sure the one
+    # there is ours and closed to everyone else
+    try:
+        os.mkdir (path, 0700)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    _st = os.lstat (path)
+    if not stat.S_ISDIR (_st.st_mode) or _st.st_uid != os.getuid () or _st.st_mode & 077:
+        raise daemonError ('{0} is not a directory private to uid {1}'.format (path, os.getuid ()))
+
+def _remove_stale (path):
+    # only a socket an earlier daemon left behind is replaced
+    if not os.path.lexists (path):
+        return
+    if not _is_socket (path):
+        raise daemonError ('{0} exists and is not a socket'.format (path))
+    os.unlink (path)
+
+class pcrServer (object):
+    ''' Unix socket server handing each connection to a fixed pool of
+    worker threads, all sharing one warmStore.  The default socket goes in
+    a directory private to the user, a stale socket is replaced but
+    nothing else at path is. '''
+    def __init__ (self, path, store, jobs=4):
+        # the socket and thread modules only load in the daemon, clients
+        # import this module on every run
+        import multiprocessing.pool
+        import socket
+        if path == DEFAULT_SOCKET:
+            _private_dir (os.path.dirname (path))
+        _remove_stale (path)
+        self.server_address = path
+        self.store = store
+        self._sock = socket.socket (socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self._sock.bind (path)
+            self._sock.listen (5)
+        except socket.error:
+            self._sock.close ()
+            raise
+        self._pool = multiprocessing.pool.ThreadPool (jobs)
+    def _process (self, conn):
+        try:
+            _serve_connection (conn, self.store)
+        except Exception as e:
+            sys.stderr.write ('pcrd: request failed: {0}\n'.format (e))
+        finally:
+            conn.close ()
+    def serve_forever (self):
+        import socket
+        while True:
+            try:
+                _conn, _address = self._sock.accept ()
+            except socket.error as e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            self._pool.apply_async (self._process, (_conn,))
+    def server_close (self):
+        self._sock.close ()
+        self._pool.close ()
+        if _is_socket (self.server_address):
+            os.unlink (self.server_address)
+
+def _peer_uid (sock):
+    # uid of the process at the other end, None where Linux peer
+    # credentials aren't available
+    import socket
+    if not sys.platform.startswith ('linux'):
+        return None
+    # Python 2 doesn't name SO_PEERCRED, 17 is its Linux value
+    _pid, _uid, _gid = _UCRED.unpack (sock.getsockopt (socket.SOL_SOCKET, getattr (socket, 'SO_PEERCRED', 17), _UCRED.size))
+    return _uid
+
+class pcrClient (object):
+    ''' Connection to a daemon, which must run as the same user: anyone
+    else answering on the socket could hand back forged PCR values. '''
+    def __init__ (self, path, timeout=1.0):
+        import socket
+        self._sock = socket.socket (socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.settimeout (timeout)
+        self._sock.connect (path)
+        _uid = _peer_uid (self._sock)
+        if _uid is not None and _uid != os.getuid ():
+            self._sock.close ()
+            raise daemonError ('daemon on {0} runs as uid {1}, not {2}'.format (path, _uid, os.getuid ()))
+        # only connecting is bounded, hashing a large module may take a while
+        self._sock.settimeout (None)
+        self._file = self._sock.makefile ('rwb')
+    def request (self, **request):
+        import json
+        self._file.write (json.dumps (request) + '\n')
+        self._file.flush ()
+        _line = self._file.readline ()
+        if not _line:
+            raise daemonError ('daemon closed the connection')
+        _response = json.loads (_line)
+        if not _response.get ('ok'):
+            if _response.get ('error_type') == 'MLEError':
+                raise txt.MLEError (_response ['error'])
+            raise daemonError (_response.get ('error', 'request failed'))
+        return _response
+    def compute (self, op, **request):
+        return result_from_json (self.request (op=op, **request))
+    def close (self):
+        self._file.close ()
+        self._sock.close ()
+
+def add_daemon_args (parser):
+    daemon_help = 'pcrd socket to use when a daemon is running, default ${0} or {1}'.format (ENV_VAR, DEFAULT_SOCKET)
+    no_daemon_help = 'always calculate in this process'
+    parser.add_argument ('--daemon', help=daemon_help, default=os.environ.get (ENV_VAR, DEFAULT_SOCKET))
+    parser.add_argument ('--no-daemon', help=no_daemon_help, action='store_true')
+
+def _owned_socket (path):
+    # a socket we created ourselves, not something another user put there
+    try:
+        _st = os.lstat (path)
+    except OSError:
+        return False
+    return stat.S_ISSOCK (_st.st_mode) and _st.st_uid == os.getuid ()
+
+def connect (args):
+    ''' A pcrClient when a daemon of this user answers on the socket, None
+    otherwise so the caller calculates locally. '''
+    if args.no_daemon or not args.daemon or not _owned_socket (args.daemon):
+        return None
+    import socket
+    try:
+        return pcrClient (args.daemon)
+    except (socket.error, daemonError):
+        return None
+
+def try_request (client, **request):
+    ''' The daemon's response, or None when there is no daemon or it could
+    not answer so the caller calculates locally.  An MLEError from the
+    daemon is raised as if it happened here. '''
+    if client is None:
+        return None
+    import socket
+    try:
+        return client.request (**request)
+    except (daemonError, socket.error, ValueError):
+        return None
+
+def try_compute (client, op, **request):
+    _response = try_request (client, op=op, **request)
+    return None if _response is None else result_from_json (_response)
@@ -0,0 +1,138 @@
+#
+# Copyright 2013 Philip Tricca <flihp@twobit.us>
+#
+# synthetic TXT inputs: ACMs, TXT heaps, LCPs, MLEs and modules laid out
+# the way txt parses them, for benchmarks and experiments without hardware
+
+import cStringIO
+import gzip
+import hashlib
+import os
+import struct
+
+import txt
+
+def pseudo_bytes (seed, length):
+    ''' length deterministic bytes that don't compress, SHA-256 in counter
+    mode over seed. '''
+    _parts = []
+    for _block in xrange ((length + 31) // 32):
+        _parts.append (hashlib.sha256 ('{0}:{1}'.format (seed, _block)).digest ())
+    return ''.join (_parts) [:length]
+
+def acm_bytes (user_area=200 * 1024, key_size=64, scratch_size=143, chipset=0xb001, date=0x20120315, seed='acm'):
+    ''' SINIT ACM image: header, RSA key, signature and scratch at the
+    offsets acmParse expects, followed by user_area bytes of code. '''
+    _layout = txt.acmParse._LAYOUT
+    _size = txt.acmParse._SCRATCH_OFFSET + scratch_size * 4 + user_area
+    _header = _layout.struct.pack (2, 0, 161, 0x10000, chipset, 0x8000, 0x8086, date,
+                                   _size // 4, 0, 0, 0, 0, 0, 0, 0,
+                                   pseudo_bytes (seed + ':reserved', 64), key_size, scratch_size)
+    _key = pseudo_bytes (seed + ':key', key_size * 4)
+    _key = _key.ljust (txt.acmParse._RSA_PUBEXP_OFFSET - len (_header), '\x00')
+    return ''.join ((_header, _key, struct.pack ('<I', 65537),
+                     pseudo_bytes (seed + ':sig', txt.acmParse._RSA_SIG_SIZE),
+                     pseudo_bytes (seed + ':scratch', scratch_size * 4),
+                     pseudo_bytes (seed + ':user', user_area)))
+
+def sinit_hash (acm, edx=0, smd=8):
+    ''' The SinitHash a TXT heap holds after launching with this ACM. '''
+    _digest = txt.acmParse (cStringIO.StringIO (acm), False, smd).Digest ()
+    _pcr = txt.pcrEmu ()
+    _pcr.extend (hashlib.sha1 (_digest + txt.senter_flags (edx)).digest ())
+    return _pcr.read ()
+
+def _heap_section (data):
+    return struct.pack ('<Q', len (data) + 8) + data
+
+def heap_bytes (version=8, sinit_hash=None, capabilities=0x3, os_sinit_version=5, seed='heap'):
+    ''' TXT heap with the four data areas, SinitMleData at the given table
+    version (5 to 8) and OsSinitData at os_sinit_version (4 or 5). '''
+    _os_sinit = txt._versioned_layout (txt.osSinitData._LAYOUTS, os_sinit_version)
+    _os_values = [os_sinit_version, 0, 0x1000, 0x20000, 0x2000, 0, 0x1000000, 0, 0, 0, 0, capabilities, 0]
+    _os_sinit_data = _os_sinit.struct.pack (*_os_values [:len (_os_sinit.fields ())])
+    _sinit_mle = txt._versioned_layout (txt.sinitMleData._LAYOUTS, version)
+    _values = [version, pseudo_bytes (seed + ':bios_acm_id', 20), 0, 0,
+               sinit_hash or pseudo_bytes (seed + ':sinit_hash', 20),
+               pseudo_bytes (seed + ':mle_hash', 20), '\x00' * 20, '\x00' * 20,
+               0, 0x9a000, 0, 3, 0x90, 0x200, 0x100, 0x1]
+    _sinit_mle_data = _sinit_mle.struct.pack (*_values [:len (_sinit_mle.fields ())])
+    # MDRs and the VT-d DMAR table follow the fixed fields
+    _sinit_mle_data += pseudo_bytes (seed + ':tables', 0x200)
+    return ''.join ((_heap_section (pseudo_bytes (seed + ':bios', 40)),
+                     _heap_section (pseudo_bytes (seed + ':os_mle', 64)),
+                     _heap_section (_os_sinit_data),
+                     _heap_section (_sinit_mle_data),
+                     '\xff' * 64))
+
+def lcp_bytes (policy_control=0x3, entries=((0, 0xff, 0, 0), (0x81, 19, 0, 2)), seed='lcp'):
+    ''' tboot launch control policy, entries are (mod_num, pcr, hash_type,
+    number of hashes) and get that many SHA-1 sized hashes each. '''
+    _entries = []
+    for _index, (_mod_num, _pcr, _hash_type, _num_hashes) in enumerate (entries):
+        _hashes = pseudo_bytes ('{0}:{1}'.format (seed, _index), 20 * _num_hashes)
+        _entries.append ((_mod_num, _pcr, _hash_type, [_hashes [_i:_i + 20] for _i in xrange (0, len (_hashes), 20)]))
+    return txt.policy_bytes (_entries, policy_control)
+
+def mle_elf_bytes (text=300 * 1024, bss=100 * 1024, header_offset=4096, cmdline_size=0x200, seed='mle'):
+    ''' ELF32 executable with one PT_LOAD segment of text bytes followed
+    by bss zero filled bytes, an MLE header at header_offset. '''
+    _header = txt.mleHeader._LAYOUT.struct.pack (txt.MLEUtil._MLE_UUID_BYTES, 0x34, 0x20003, 0, 0, 0,
+                                                 text, 0x3, 0x2000, 0x2000 + cmdline_size)
+    _body = pseudo_bytes (seed, text)
+    _body = _body [:header_offset] + _header + _body [header_offset + len (_header):]
+    _data_offset = 0x100
+    _elf = '\x7fELF\x01\x01\x01' + '\x00' * 9
+    _elf += struct.pack ('<HHIIIIIHHHHHH', 2, 3, 1, 0x100000, 52, 0, 0, 52, 32, 1, 40, 0, 0)
+    _elf += struct.pack ('<IIIIIIII', 1, _data_offset, 0x100000, 0x100000, text, text + bss, 7, 0x1000)
+    return _elf.ljust (_data_offset, '\x00') + _body
+
+def gzip_bytes (data):
+    _out = cStringIO.StringIO ()
+    _gz = gzip.GzipFile (fileobj=_out, mode='wb')
+    _gz.write (data)
+    _gz.close ()
+    return _out.getvalue ()
+
+def write_sparse (path, size, data_every=64 * 1024 * 1024, data_length=4096, seed='module'):
+    ''' A module of size bytes that costs almost no disk: holes with
+    data_length bytes of data every data_every bytes. '''
+    with open (path, 'wb') as _fobj:
+        _offset = 0
+        while _offset < size:
+            _fobj.seek (_offset)
+            _fobj.write (pseudo_bytes ('{0}:{1}'.format (seed, _offset), min (data_length, size - _offset)))
+            _offset += data_every
+        _fobj.truncate (size)
+
+def _write (path, data):
+    with open (path, 'wb') as _fobj:
+        _fobj.write (data)
+    return path
+
+def generate (directory, user_area=200 * 1024, smd=8, mle_text=300 * 1024, mle_bss=100 * 1024,
+              module_size=64 * 1024 * 1024, mle_args='logging=serial'):
+    ''' Write a consistent set of inputs into directory, the heap's
+    SinitHash matches the ACM.  Returns {name: path}; modules come with
+    a .cmd file holding their command line. '''
+    if not os.path.isdir (directory):
+        os.makedirs (directory)
+    _paths = dict ()
+    _acm = acm_bytes (user_area)
+    _paths ['acm'] = _write (os.path.join (directory, 'acm.bin'), _acm)
+    _paths ['heap'] = _write (os.path.join (directory, 'heap.bin'), heap_bytes (smd, sinit_hash (_acm, 0, smd)))
+    _paths ['lcp'] = _write (os.path.join (directory, 'lcp.bin'), lcp_bytes ())
+    _elf = mle_elf_bytes (mle_text, mle_bss)
+    _paths ['mle'] = _write (os.path.join (directory, 'mle.elf'), _elf)
+    _paths ['mle.gz'] = _write (os.path.join (directory, 'mle.gz'), gzip_bytes (_elf))
+    _paths ['mle_args'] = mle_args
+    for _name, _size, _cmdline in (('kernel', 4 * 1024 * 1024, '/boot/vmlinuz root=/dev/sda1 ro quiet'),
+                                   ('initrd', module_size, '/boot/initrd.img')):
+        _path = os.path.join (directory, _name)
+        if _name == 'kernel':
+            _write (_path, pseudo_bytes (_name, _size))
+        else:
+            write_sparse (_path, _size, seed=_name)
+        _paths [_name] = _path
+        _paths [_name + '.cmd'] = _write (_path + '.cmd', _cmdline + '\n')
+    return _paths
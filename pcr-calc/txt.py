@@ -3,16 +3,25 @@
 #
 # module for interacting with stuff from TXT
 
+import argparse
+import array
 import base64
-from elftools.elf.elffile import ELFFile
-from elftools.common.exceptions import ELFError
-from gzip import GzipFile
+import binascii
+import collections
+import cStringIO
 import hashlib
+import itertools
 import struct
-import datetime
 import mmap
-import tempfile
-import uuid
+import os
+import stat
+import sys
+import threading
+import time
+
+# pyelftools, gzip, datetime, uuid, random and multiprocessing are imported
+# where they are used: every script imports this module, and most of them
+# never touch an MLE, so they shouldn't pay for loading them
 
 class acmFlags(object):
     def __init__(self, stuff):
@@ -28,37 +37,117 @@ class acmFlags(object):
     def Raw(self):
         return self._flags
 
+# precompiled little-endian unsigned integer formats, keyed by field width
+_UINT_STRUCT = {
+    1 : struct.Struct ('<B'),
+    2 : struct.Struct ('<H'),
+    4 : struct.Struct ('<I'),
+    8 : struct.Struct ('<Q'),
+    }
+
+# field types understood by recordLayout
+FIELD_UINT = 'uint'
+FIELD_BYTES = 'bytes'
+FIELD_PAD = 'pad'
+
+class recordLayout(object):
+    ''' (name, width, type) fields decoded with one struct call into a namedtuple '''
+    _UINT_FMT = { 1 : 'B', 2 : 'H', 4 : 'I', 8 : 'Q' }
+    def __init__ (self, name, fields):
+        self._name = name
+        self._spec = tuple (fields)
+        self.offset = dict ()
+        self.width = dict ()
+        self.kind = dict ()
+        _fmt = '<'
+        _pos = 0
+        for _field, _width, _type in self._spec:
+            if _type == FIELD_PAD:
+                # skipped bytes, not part of the record
+                _fmt += '{0}x'.format (_width)
+                _pos += _width
+                continue
+            if _type == FIELD_UINT:
+                _fmt += self._UINT_FMT [_width]
+            else:
+                _fmt += '{0}s'.format (_width)
+            self.offset [_field] = _pos
+            self.width [_field] = _width
+            self.kind [_field] = _type
+            _pos += _width
+        self.struct = struct.Struct (_fmt)
+        self.size = self.struct.size
+        self.record = collections.namedtuple (name, [_f [0] for _f in self._spec if _f [2] != FIELD_PAD])
+    @classmethod
+    def at_offsets (cls, name, fields, size):
+        _spec = []
+        _pos = 0
+        for _field, _offset, _width, _type in sorted (fields, key=lambda _f: _f [1]):
+            if _offset > _pos:
+                _spec.append ((None, _offset - _pos, FIELD_PAD))
+            _spec.append ((_field, _width, _type))
+            _pos = _offset + _width
+        if size > _pos:
+            _spec.append ((None, size - _pos, FIELD_PAD))
+        return cls (name, _spec)
+    def extend (self, name, fields):
+        # layout of a later table version that appends fields to this one
+        return recordLayout (name, self._spec + tuple (fields))
+    def fields (self):
+        return self.record._fields
+    def unpack_from (self, buf, offset=0):
+        return self.record._make (self.struct.unpack_from (buf, offset))
+
+def _versioned_layout (layouts, version):
+    # newest layout not newer than the table version, oldest one otherwise
+    _known = [_v for _v in layouts if _v <= version]
+    if _known:
+        return layouts [max (_known)]
+    return layouts [min (layouts)]
+
 class binParse(object):
+    _LAYOUT = None
     def __init__ (self, pfile, pmap=None):
         self._filemmap = pmap
-        self._unpack_int = {
-            1 : self._unpack_uint8,
-            2 : self._unpack_uint16,
-            4 : self._unpack_uint32,
-            8 : self._unpack_uint64,
-            }
+        self._record_offset = 0
+        self._rec = None
+    def _read_view (self, offset, length):
+        # zero-copy buffer over the map, only reads from the file when unmapped
+        if self._filemmap is not None:
+            return buffer (self._filemmap, offset, length)
+        self._file.seek (self._offset + offset)
+        return self._file.read (length)
     def _read_bytes_raw (self, offset, length):
-        if self._filemmap:
-            _tmp = self._filemmap [offset : offset + length]
-        else:
-            self._file.seek (self._offset + offset)
-            _tmp = self._file.read (length)
-        return _tmp
+        return str (self._read_view (offset, length))
     def _read_bytes(self, offset, length):
-        _tmp = self._read_bytes_raw (offset, length)
-        inttup = struct.unpack ('<{0}B'.format(length), _tmp)
-        return bytearray (inttup)
+        return bytearray (self._read_view (offset, length))
     def _read_uint (self, offset, length):
-        _tmp = self._read_bytes_raw (offset, length)
-        return self._unpack_int [length] (_tmp)
-    def _unpack_uint8 (self, data):
-        return struct.unpack ('<c', data)[0]
-    def _unpack_uint16 (self, data):
-        return struct.unpack ('<H', data)[0]
-    def _unpack_uint32 (self, data):
-        return struct.unpack ('<I', data)[0]
-    def _unpack_uint64 (self, data):
-        return struct.unpack ('<Q', data)[0]
+        _struct = _UINT_STRUCT [length]
+        if self._filemmap is not None:
+            return _struct.unpack_from (self._filemmap, offset)[0]
+        return _struct.unpack (self._read_view (offset, length))[0]
+    def _read_record (self, layout, offset=0):
+        if self._filemmap is not None:
+            return layout.unpack_from (self._filemmap, offset)
+        return layout.unpack_from (self._read_view (offset, layout.size))
+    def _Layout (self):
+        return self._LAYOUT
+    def _fields (self):
+        # the whole fixed-size header is decoded once, on first access
+        if self._rec is None:
+            self._rec = self._read_record (self._Layout (), self._record_offset)
+        return self._rec
+    def _field (self, name):
+        try:
+            return getattr (self._fields (), name)
+        except AttributeError:
+            # not part of this table version, read it where the newest
+            # layout puts it
+            _offset = self._record_offset + self._LAYOUT.offset [name]
+            _width = self._LAYOUT.width [name]
+            if self._LAYOUT.kind [name] == FIELD_UINT:
+                return self._read_uint (_offset, _width)
+            return str (self._read_bytes (_offset, _width))
 
 class mapParse(binParse):
     def __init__(self, pfile, pmmap=False, poffset=0, psize=0):
@@ -129,90 +218,118 @@ class acmParse(mapParse):
     _RSA_SIG_SIZE = 256
     _SCRATCH_OFFSET = _RSA_SIG_OFFSET + _RSA_SIG_SIZE
     # need to know scratch size and file size to calculate UserArea stuff
+    # fixed header up to the RSA public key, decoded in one pass
+    _LAYOUT = recordLayout ('acmHeader', (
+        ('ModuleType', _MODULE_TYPE_SIZE, FIELD_UINT),
+        ('ModuleSubType', _MODULE_SUBTYPE_SIZE, FIELD_UINT),
+        ('HeaderLen', _HEADER_LENGTH_SIZE, FIELD_UINT),
+        ('HeaderVersion', _HEADER_VERSION_SIZE, FIELD_UINT),
+        ('ChipsetID', _CHIPSET_ID_SIZE, FIELD_UINT),
+        ('Flags', _FLAGS_SIZE, FIELD_UINT),
+        ('ModuleVendor', _MODULE_VENDOR_SIZE, FIELD_UINT),
+        ('Date', _DATE_SIZE, FIELD_UINT),
+        ('Size', _MODULE_SIZE_SIZE, FIELD_UINT),
+        ('Reserved1', _RESERVED1_SIZE, FIELD_UINT),
+        ('CodeControl', _CODE_CONTROL_SIZE, FIELD_UINT),
+        ('ErrorEntryPoint', _ERROR_ENTRY_POINT_SIZE, FIELD_UINT),
+        ('GDTLimit', _GDT_LIMIT_SIZE, FIELD_UINT),
+        ('GDTBasePtr', _GDT_BASE_PTR_SIZE, FIELD_UINT),
+        ('SegSel', _SEGMENT_SELECTOR_SIZE, FIELD_UINT),
+        ('EntryPoint', _ENTRY_POINT_SIZE, FIELD_UINT),
+        ('Reserved2', _RESERVED2_SIZE, FIELD_BYTES),
+        ('KeySize', _KEY_SIZE_SIZE, FIELD_UINT),
+        ('ScratchSize', _SCRATCH_SIZE_SIZE, FIELD_UINT),
+        ))
 
-    def __init__ (self, pfile, pmmap=False, sinitmledtv=8):
+    _HASH_ALGS = ('sha1', 'sha256')
+    _HASH_CHUNK_SIZE = 64 * 1024
+
+    def __init__ (self, pfile, pmmap=False, sinitmledtv=8, cache=None):
         super (acmParse, self).__init__ (pfile, pmmap)
         self._sinit_mle_dtv = sinitmledtv
+        self._cache = cache
+        self._hashobjs = dict ()
 
     # public accessor functions
     def ModuleType(self):
-        return self._read_uint (self._MODULE_TYPE_OFFSET, self._MODULE_TYPE_SIZE)
+        return self._fields ().ModuleType
     def ModuleType_Bytes(self):
         return self._read_bytes (self._MODULE_TYPE_OFFSET, self._MODULE_TYPE_SIZE)
     def ModuleSubType(self):
-        return self._read_uint (self._MODULE_SUBTYPE_OFFSET, self._MODULE_SUBTYPE_SIZE)
+        return self._fields ().ModuleSubType
     def ModuleSubType_Bytes(self):
         return self._read_bytes (self._MODULE_SUBTYPE_OFFSET, self._MODULE_SUBTYPE_OFFSET)
     def HeaderLen(self):
-        return self._read_uint (self._HEADER_LENGTH_OFFSET, self._HEADER_LENGTH_SIZE)
+        return self._fields ().HeaderLen
     def HeaderLen_Bytes(self):
         return self._read_bytes (self._HEADER_LENGTH_OFFSET, self._HEADER_LENGTH_SIZE)
     def HeaderVersion(self):
-        return self._read_uint (self._HEADER_VERSION_OFFSET, self._HEADER_VERSION_SIZE)
+        return self._fields ().HeaderVersion
     def HeaderVersion_Bytes(self):
         return self._read_bytes (self._HEADER_VERSION_OFFSET, self._HEADER_VERSION_SIZE)
     def ChipsetID(self):
-        return self._read_uint (self._CHIPSET_ID_OFFSET, self._CHIPSET_ID_SIZE)
+        return self._fields ().ChipsetID
     def ChipsetID_Bytes(self):
         return self._read_bytes (self._CHIPSET_ID_OFFSET, self._CHIPSET_ID_SIZE)
     def Flags(self):
-        return acmFlags (self._read_uint (self._FLAGS_OFFSET, self._FLAGS_SIZE))
+        return acmFlags (self._fields ().Flags)
     def Flags_Bytes(self):
         return self._read_bytes (self._FLAGS_OFFSET, self._FLAGS_SIZE)
     def ModuleVendor(self):
-        return self._read_uint (self._MODULE_VENDOR_OFFSET, self._MODULE_VENDOR_SIZE)
+        return self._fields ().ModuleVendor
     def ModuleVendor_Bytes(self):
         return self._read_bytes (self._MODULE_VENDOR_OFFSET, self._MODULE_VENDOR_SIZE)
     def Date(self):
-        return self._read_uint (self._DATE_OFFSET, self._DATE_SIZE)
+        return self._fields ().Date
     def DateObj(self):
         self._datebcd = self.Date ()
         _year = int (hex (self._datebcd >> 16)[2:])
         _month = int (hex ((self._datebcd >> 8) & 0x0000FF)[2:])
         _day = int (hex (self._datebcd & 0x000000F)[2:])
+        import datetime
         return datetime.date (_year, _month, _day)
     def Date_Bytes(self):
         return self._read_bytes (self._DATE_OFFSET, self._DATE_SIZE)
     def Size(self):
-        return self._read_uint (self._MODULE_SIZE_OFFSET, self._MODULE_SIZE_SIZE)
+        return self._fields ().Size
     def Size_Bytes(self):
         return self._read_bytes (self._MODULE_SIZE_OFFSET, self._MODULE_SIZE_SIZE)
     def Reserved1(self):
-        return self._read_uint (self._RESERVED1_OFFSET, self._RESERVED1_SIZE)
+        return self._fields ().Reserved1
     def Reserved1_Bytes(self):
         return self._read_bytes (self._RESERVED1_OFFSET, self._RESERVED1_SIZE)
     def CodeControl(self):
-        return self._read_uint (self._CODE_CONTROL_OFFSET, self._CODE_CONTROL_SIZE)
+        return self._fields ().CodeControl
     def CodeControl_Bytes(self):
         return self._read_bytes (self._CODE_CONTROL_OFFSET, self._CODE_CONTROL_SIZE)
     def ErrorEntryPoint(self):
-        return self._read_uint (self._ERROR_ENTRY_POINT_OFFSET, self._ERROR_ENTRY_POINT_SIZE)
+        return self._fields ().ErrorEntryPoint
     def ErrorEntryPoint_Bytes(self):
         return self._read_bytes (self._ERROR_ENTRY_POINT_OFFSET, self._ERROR_ENTRY_POINT_SIZE)
     def GDTLimit(self):
-        return self._read_uint (self._GDT_LIMIT_OFFSET, self._GDT_LIMIT_SIZE)
+        return self._fields ().GDTLimit
     def GDTLimit_Bytes(self):
         return self._read_bytes (self._GDT_LIMIT_OFFSET, self._GDT_LIMIT_SIZE)
     def GDTBasePtr(self):
-        return self._read_uint (self._GDT_BASE_PTR_OFFSET, self._GDT_BASE_PTR_SIZE)
+        return self._fields ().GDTBasePtr
     def GDTBasePtr_Bytes(self):
         return self._read_bytes (self._GDT_BASE_PTR_OFFSET, self._GDT_BASE_PTR_SIZE)
     def SegSel(self):
-        return self._read_uint (self._SEGMENT_SELECTOR_OFFSET, self._SEGMENT_SELECTOR_SIZE)
+        return self._fields ().SegSel
     def SegSel_Bytes(self):
         return self._read_bytes (self._SEGMENT_SELECTOR_OFFSET, self._SEGMENT_SELECTOR_SIZE)
     def EntryPoint(self):
-        return self._read_uint (self._ENTRY_POINT_OFFSET, self._ENTRY_POINT_SIZE)
+        return self._fields ().EntryPoint
     def EntryPoint_Bytes(self):
         return self._read_bytes (self._ENTRY_POINT_OFFSET, self._ENTRY_POINT_SIZE)
     def Reserved2(self):
-        return self._read_bytes (self._RESERVED2_OFFSET, self._RESERVED2_SIZE)
+        return bytearray (self._fields ().Reserved2)
     def KeySize(self):
-        return self._read_uint (self._KEY_SIZE_OFFSET, self._KEY_SIZE_SIZE)
+        return self._fields ().KeySize
     def KeySize_Bytes(self):
         return self._read_bytes (self._KEY_SIZE_OFFSET, self._KEY_SIZE_SIZE)
     def ScratchSize(self):
-        return self._read_uint (self._SCRATCH_SIZE_OFFSET, self._SCRATCH_SIZE_SIZE)
+        return self._fields ().ScratchSize
     def ScratchSize_Bytes(self):
         return self._read_bytes (self._SCRATCH_SIZE_OFFSET, self._SCRATCH_SIZE_SIZE)
     def RSAPubKey(self):
@@ -226,43 +343,60 @@ class acmParse(mapParse):
         return self._read_bytes (self._RSA_SIG_OFFSET, self._RSA_SIG_SIZE)
     def Scratch(self):
         return self._read_bytes (self._SCRATCH_OFFSET, self.ScratchSize () * 4)
+    def _UserAreaOffset(self):
+        return self._SCRATCH_OFFSET + (self.ScratchSize () * 4)
+    def _UserAreaView(self):
+        _userarea_offset = self._UserAreaOffset ()
+        return self._read_view (_userarea_offset, self._file_size - _userarea_offset)
     def UserArea(self):
-        _userarea_offset = self._SCRATCH_OFFSET + (self.ScratchSize () * 4)
-        _userarea_size = self._file_size - _userarea_offset
-        return self._read_bytes (_userarea_offset, _userarea_size)
-    def _HashObj (self):
-        # select hash algorithm for ACM based on SINIT to MLE Data Table version
-        if self._sinit_mle_dtv > 6:
-            acmhash = hashlib.sha256 ()
-        else:
-            acmhash = hashlib.sha1 ()
-        # We don't hash these fields: RSAPubKey, RSAPubExp, RSASig, Scratch 
+        return bytearray (self._UserAreaView ())
+    def _HashedRanges (self):
+        # We don't hash these fields: RSAPubKey, RSAPubExp, RSASig, Scratch
         # See section A.1.2 of the Intel MLE Developer's Guide for details.
-        acmhash.update (self.ModuleType_Bytes ())
-        acmhash.update (self.ModuleSubType_Bytes ())
-        acmhash.update (self.HeaderLen_Bytes ())
-        acmhash.update (self.HeaderVersion_Bytes ())
-        acmhash.update (self.ChipsetID_Bytes ())
-        acmhash.update (self.Flags_Bytes ())
-        acmhash.update (self.ModuleVendor_Bytes ())
-        acmhash.update (self.Date_Bytes ())
-        acmhash.update (self.Size_Bytes ())
-        acmhash.update (self.Reserved1_Bytes ())
-        acmhash.update (self.CodeControl_Bytes ())
-        acmhash.update (self.ErrorEntryPoint_Bytes ())
-        acmhash.update (self.GDTLimit_Bytes ())
-        acmhash.update (self.GDTBasePtr_Bytes ())
-        acmhash.update (self.SegSel_Bytes ())
-        acmhash.update (self.EntryPoint_Bytes ())
-        acmhash.update (self.Reserved2 ())
-        acmhash.update (self.KeySize_Bytes ())
-        acmhash.update (self.ScratchSize_Bytes ())
-        acmhash.update (self.UserArea ())
-        return acmhash
-    def Digest (self):
-        return self._HashObj ().digest ()
-    def HexDigest (self):
-        return self._HashObj ().hexdigest ()
+        # What's left is the header up to the RSA public key and the UserArea.
+        _userarea_offset = self._UserAreaOffset ()
+        return ((self._MODULE_TYPE_OFFSET, self._RSA_PUBKEY_OFFSET),
+                (_userarea_offset, self._file_size - _userarea_offset))
+    def _HashObjs (self, algs=_HASH_ALGS):
+        # hash every requested algorithm not cached yet in one pass
+        _hashes = dict ((_alg, hashlib.new (_alg)) for _alg in algs if _alg not in self._hashobjs)
+        if _hashes:
+            _updates = [_hash.update for _hash in _hashes.itervalues ()]
+            with stage ('acm_hash') as _stage:
+                for _offset, _length in self._HashedRanges ():
+                    _end = _offset + _length
+                    while _offset < _end:
+                        _chunk = self._read_view (_offset, min (self._HASH_CHUNK_SIZE, _end - _offset))
+                        for _update in _updates:
+                            _update (_chunk)
+                        _offset += self._HASH_CHUNK_SIZE
+                    _stage.read += _length
+                    _stage.hashed += _length
+            self._hashobjs.update (_hashes)
+        return self._hashobjs
+    def _HashObj (self, sinitmledtv=None):
+        # select hash algorithm for ACM based on SINIT to MLE Data Table
+        # version, the one given or the one this ACM was opened with
+        if sinitmledtv is None:
+            sinitmledtv = self._sinit_mle_dtv
+        if sinitmledtv > 6:
+            _alg = 'sha256'
+        else:
+            _alg = 'sha1'
+        if self._cache is not None:
+            _digest = self._cache.lookup (self._file, _alg)
+            if _digest is not None:
+                return cachedDigest (_digest)
+        _hash = self._HashObjs ((_alg,)) [_alg]
+        if self._cache is not None:
+            self._cache.store (self._file, _alg, '', _hash.digest ())
+        return _hash.copy ()
+    def Digests (self):
+        return dict ((_alg, _hash.digest ()) for _alg, _hash in self._HashObjs ().iteritems ())
+    def Digest (self, sinitmledtv=None):
+        return self._HashObj (sinitmledtv).digest ()
+    def HexDigest (self, sinitmledtv=None):
+        return self._HashObj (sinitmledtv).hexdigest ()
 
 class pubConfRegsParse(mapParse):
     _REG_SIZE = 8 # all regs are 64 bits per the spec
@@ -290,46 +424,117 @@ class pubConfRegsParse(mapParse):
     _TXT_CMD_SECRETS_OFFSET = 0x8e0
     _TXT_CMD_NOSECRETS_OFFSET = 0x8e8
     _TXT_E2STS_OFFSET = 0xef0
-    def __init__(self, pfile, pmmap=False, from_mem=False):
+    _SIZE = (_TXT_E2STS_OFFSET + _REG_SIZE) - _TXT_STS_OFFSET
+    _PUBLIC_KEY_LENGTH = 32
+    # the readable registers, the command registers between them skipped
+    _LAYOUT = recordLayout.at_offsets ('txtPubConfRegs', (
+        ('Status', _TXT_STS_OFFSET, _REG_SIZE, FIELD_UINT),
+        ('ErrorStatus', _TXT_ESTS_OFFSET, _REG_SIZE, FIELD_UINT),
+        ('ErrorCode', _TXT_ERRORCODE_OFFSET, _REG_SIZE, FIELD_UINT),
+        ('FSBInterface', _TXT_VER_FSBIF_OFFSET, _REG_SIZE, FIELD_UINT),
+        ('DeviceID', _TXT_DIDVID_OFFSET, _REG_SIZE, FIELD_UINT),
+        ('QuickPath', _TXT_VER_QPIIF_OFFSET, _REG_SIZE, FIELD_UINT),
+        ('SINITBase', _TXT_SINIT_BASE_OFFSET, _REG_SIZE, FIELD_UINT),
+        ('SINITSize', _TXT_SINIT_SIZE_OFFSET, _REG_SIZE, FIELD_UINT),
+        ('MLEJoinBase', _TXT_MLE_JOIN_OFFSET, _REG_SIZE, FIELD_UINT),
+        ('HeapBase', _TXT_HEAP_BASE_OFFSET, _REG_SIZE, FIELD_UINT),
+        ('HeapSize', _TXT_HEAP_SIZE_OFFSET, _REG_SIZE, FIELD_UINT),
+        ('DMAProtected', _TXT_DPR_OFFSET, _REG_SIZE, FIELD_UINT),
+        ('PublicKey', _TXT_PUBLIC_KEY_OFFSET, _PUBLIC_KEY_LENGTH, FIELD_BYTES),
+        ('ExtErrorStatus', _TXT_E2STS_OFFSET, _REG_SIZE, FIELD_UINT),
+        ), _SIZE)
+    def __init__(self, pfile, pmmap=False, from_mem=False, poffset=0):
         self._mmap = pmmap
-        self._offset = 0
-        self._size = (self._TXT_E2STS_OFFSET + self._REG_SIZE) - self._TXT_STS_OFFSET
+        self._offset = poffset
+        self._size = self._SIZE
         if from_mem:
             self._offset = self._TXT_PUB_CONFIG_REGS_BASE
         super (pubConfRegsParse, self).__init__ (pfile, pmmap, poffset=self._offset, psize=self._size)
+        self.refresh ()
+    def _read_live (self, offset, length):
+        # past the file object's buffer, which would hand back what an
+        # earlier read saw instead of the registers' current values
+        if self._filemmap is not None or not _can_map (self._file):
+            return self._read_bytes_raw (offset, length)
+        _fd = self._file.fileno ()
+        os.lseek (_fd, self._offset + offset, os.SEEK_SET)
+        _parts = []
+        while length:
+            _part = os.read (_fd, length)
+            if not _part:
+                break
+            _parts.append (_part)
+            length -= len (_part)
+        return ''.join (_parts)
+    def refresh (self):
+        self._window = self._read_live (self._TXT_STS_OFFSET, self._size)
+        if len (self._window) < self._size:
+            raise IOError ('TXT config registers truncated: {0:#x} of {1:#x} bytes'.format (len (self._window), self._size))
+        self._rec = self._LAYOUT.unpack_from (self._window)
+        return self._rec
+    def Registers (self):
+        return self._rec
+    def Poll (self, names):
+        ''' read from the device one by one, not from the snapshot '''
+        _values = []
+        for _name in names:
+            _width = self._LAYOUT.width [_name]
+            _value = self._read_live (self._LAYOUT.offset [_name], _width)
+            if len (_value) < _width:
+                raise IOError ('TXT config register {0} truncated'.format (_name))
+            _values.append (_UINT_STRUCT [_width].unpack (_value) [0])
+        return tuple (_values)
+    def Bytes (self):
+        return self._window
     # readable config registers
     def Status (self):
-        return self._read_uint (self._TXT_STS_OFFSET, self._REG_SIZE)
+        return self._rec.Status
     def ErrorStatus (self):
-        return self._read_uint (self._TXT_ESTS_OFFSET, self._REG_SIZE)
+        return self._rec.ErrorStatus
     def ErrorCode (self):
-        return self._read_uint (self._TXT_ERRORCODE_OFFSET, self._REG_SIZE)
+        return self._rec.ErrorCode
     def FSBInterface (self):
-        return self._read_uint (self._TXT_VER_FSBIF_OFFSET, self._REG_SIZE)
+        return self._rec.FSBInterface
     def DeviceID (self):
-        return self._read_uint (self._TXT_DIDVID_OFFSET, self._REG_SIZE)
+        return self._rec.DeviceID
     def QuickPath (self):
-        return self._read_uint (self._TXT_VER_QPIIF_OFFSET, self._REG_SIZE)
+        return self._rec.QuickPath
     def SINITBase (self):
-        return self._read_uint (self._TXT_SINIT_BASE_OFFSET, self._REG_SIZE)
+        return self._rec.SINITBase
     def SINITSize (self):
-        return self._read_uint (self._TXT_SINIT_SIZE_OFFSET, self._REG_SIZE)
+        return self._rec.SINITSize
     def MLEJoinBase (self):
-        return self._read_uint (self._TXT_MLE_JOIN_OFFSET, self._REG_SIZE)
+        return self._rec.MLEJoinBase
     def HeapBase (self):
-        return self._read_uint (self._TXT_HEAP_BASE_OFFSET, self._REG_SIZE)
+        return self._rec.HeapBase
     def HeapSize (self):
-        return self._read_uint (self._TXT_HEAP_SIZE_OFFSET, self._REG_SIZE)
+        return self._rec.HeapSize
     def DMAProtected (self):
-        return self._read_uint (self._TXT_DPR_OFFSET, self._REG_SIZE)
+        return self._rec.DMAProtected
     def PublicKey_Bytes (self):
-        _bytes = self._read_bytes (self._TXT_PUBLIC_KEY_OFFSET, 8)
-        _bytes.extend (self._read_bytes (self._TXT_PUBLIC_KEY_OFFSET + 8, 8))
-        _bytes.extend (self._read_bytes (self._TXT_PUBLIC_KEY_OFFSET + 16, 8))
-        _bytes.extend (self._read_bytes (self._TXT_PUBLIC_KEY_OFFSET + 24, 8))
-        return _bytes
+        return bytearray (self._rec.PublicKey)
     def ExtErrorStatus (self):
-        return self._read_uint (self._TXT_E2STS_OFFSET, self._REG_SIZE)
+        return self._rec.ExtErrorStatus
+
+# status registers watched for launch failures, by default
+WATCH_REGISTERS = ('Status', 'ErrorStatus', 'ExtErrorStatus')
+
+def watch_registers (regs, interval=1.0, names=WATCH_REGISTERS, count=None):
+    ''' yields (time, [(name, old, new)]) for each poll where a register changed '''
+    _last = regs.Poll (names)
+    _next = time.time ()
+    _polls = 0
+    while count is None or _polls < count:
+        _next += interval
+        time.sleep (max (0, _next - time.time ()))
+        _values = regs.Poll (names)
+        _polls += 1
+        if _values != _last:
+            yield time.time (), [(_name, _old, _new) for _name, _old, _new in zip (names, _last, _values) if _old != _new]
+            _last = _values
+
+# location of one TXT heap data area, its size field not included
+heapSection = collections.namedtuple ('heapSection', ('offset', 'length'))
 
 class txtHeap (mapParse):
     _BIOS_DATA_SIZE_OFFSET = 0x0
@@ -338,40 +543,68 @@ class txtHeap (mapParse):
     _OS_MLE_DATA_SIZE_LENGTH = 0x8
     _OS_SINIT_DATA_SIZE_LENGTH = 0x8
     _SINIT_MLE_DATA_SIZE_LENGTH = 0x8
-    # need size from heap
-    # _BIOS_DATA_OFFSET = _BIOS_DATA_SIZE_LENGTH + BiosDataSize ()
-    def __init__(self, pfile, pmmap=False, offset=0x0, size=0x0):
+    # each data area follows a size field that counts itself, in this order
+    _SECTIONS = (
+        ('BiosData', _BIOS_DATA_SIZE_LENGTH),
+        ('OsMleData', _OS_MLE_DATA_SIZE_LENGTH),
+        ('OsSinitData', _OS_SINIT_DATA_SIZE_LENGTH),
+        ('SinitMleData', _SINIT_MLE_DATA_SIZE_LENGTH),
+        )
+    _BIOS_DATA_INDEX = 0
+    _OS_MLE_DATA_INDEX = 1
+    _OS_SINIT_DATA_INDEX = 2
+    _SINIT_MLE_DATA_INDEX = 3
+    def __init__(self, pfile, pmmap=False, offset=0x0, size=0x0, sections=None):
         self._mmap = pmmap
         self._offset = offset
         self._size = size
         super (txtHeap, self).__init__ (pfile, pmmap, poffset=self._offset, psize=self._size)
-    def _OsMleDataOffset (self):
-        return self.BiosDataSize () + self._BIOS_DATA_SIZE_LENGTH
-    def _OsSinitDataOffset (self):
-        return self.BiosDataSize () + self.OsMleDataSize () + self._OS_SINIT_DATA_SIZE_LENGTH
-    def _SinitMleDataOffset (self):
-        return self.BiosDataSize () + self.OsMleDataSize () + self.OsSinitDataSize () + self._SINIT_MLE_DATA_SIZE_LENGTH
+        # a snapshot's section table spares walking the size fields
+        self._sections = tuple (sections) if sections is not None else self._WalkSections ()
+    def _WalkSections (self):
+        # read the four size fields once and keep an immutable index
+        _sections = list ()
+        _offset = self._BIOS_DATA_SIZE_OFFSET
+        with stage ('heap_read') as _stage:
+            for _name, _size_length in self._SECTIONS:
+                _size = self._read_uint (_offset, _size_length)
+                _stage.read += _size_length
+                if _size < _size_length or (self._size and _offset + _size > self._size):
+                    raise IOError ('TXT heap {0} of size {1:#x} at offset {2:#x} does not fit heap of size {3:#x}'.format (_name, _size, _offset, self._size))
+                _sections.append (heapSection (_offset + _size_length, _size - _size_length))
+                _offset += _size
+        return tuple (_sections)
+    def _SectionSize (self, index):
+        return self._sections [index].length + self._SECTIONS [index][1]
+    def _SectionView (self, index):
+        with stage ('heap_read') as _stage:
+            _view = self._read_view (*self._sections [index])
+            _stage.read += len (_view)
+        return _view
 
+    def Sections (self):
+        return self._sections
     def Bytes (self):
-        return self._read_bytes (self._BIOS_DATA_SIZE_OFFSET, self.HeapLength ())
+        return self._read_view (self._BIOS_DATA_SIZE_OFFSET, self.HeapLength ())
     def BiosDataSize (self):
-        return self._read_uint (self._BIOS_DATA_SIZE_OFFSET, self._BIOS_DATA_SIZE_LENGTH)
+        return self._SectionSize (self._BIOS_DATA_INDEX)
     def BiosData (self):
-        return self._read_bytes (self._BIOS_DATA_OFFSET, self.BiosDataSize () - self._BIOS_DATA_SIZE_LENGTH)
+        return self._SectionView (self._BIOS_DATA_INDEX)
     def OsMleDataSize (self):
-        return self._read_uint (self.BiosDataSize (),self._OS_MLE_DATA_SIZE_LENGTH)
+        return self._SectionSize (self._OS_MLE_DATA_INDEX)
     def OsMleData (self):
-        return self._read_bytes (self._OsMleDataOffset (), self.OsMleDataSize () - self._OS_MLE_DATA_SIZE_LENGTH)
+        return self._SectionView (self._OS_MLE_DATA_INDEX)
     def OsSinitDataSize (self):
-        return self._read_uint (self.BiosDataSize () + self.OsMleDataSize (), self._OS_SINIT_DATA_SIZE_LENGTH)
+        return self._SectionSize (self._OS_SINIT_DATA_INDEX)
     def OsSinitData (self):
-        return self._read_bytes (self._OsSinitDataOffset (), self.OsSinitDataSize () - self._OS_SINIT_DATA_SIZE_LENGTH)
+        return self._SectionView (self._OS_SINIT_DATA_INDEX)
     def SinitMleDataSize (self):
-        return self._read_uint (self.BiosDataSize () + self.OsMleDataSize () + self.OsSinitDataSize (), self._SINIT_MLE_DATA_SIZE_LENGTH)
+        return self._SectionSize (self._SINIT_MLE_DATA_INDEX)
     def SinitMleData (self):
-        return self._read_bytes (self._SinitMleDataOffset (), self.SinitMleDataSize () - self._SINIT_MLE_DATA_SIZE_LENGTH)
+        return self._SectionView (self._SINIT_MLE_DATA_INDEX)
     def HeapLength (self):
-        return self.BiosDataSize () + self.OsMleDataSize () + self.OsSinitDataSize () + self.SinitMleDataSize ()
+        _last = self._sections [self._SINIT_MLE_DATA_INDEX]
+        return _last.offset + _last.length - self._BIOS_DATA_SIZE_OFFSET
 
 class sinitMleData (binParse):
     _VERSION_OFFSET = 0
@@ -406,46 +639,71 @@ class sinitMleData (binParse):
     _SINIT_VTD_DMAR_TABLE_OFFSET_LENGTH = 4
     _PROCESSOR_SCRTM_STATUS_OFFSET = _SINIT_VTD_DMAR_TABLE_OFFSET_OFFSET + _SINIT_VTD_DMAR_TABLE_OFFSET_LENGTH
     _PROCESSOR_SCRTM_STATUS_LENGTH = 4
+    # table layouts by version, later versions append fields
+    _LAYOUT_V5 = recordLayout ('sinitMleDataV5', (
+        ('Version', _VERSION_LENGTH, FIELD_UINT),
+        ('BiosAcmId', _BIOS_ACM_ID_LENGTH, FIELD_BYTES),
+        ('EdxSenterFlags', _EDX_SENTER_FLAGS_LENGTH, FIELD_UINT),
+        ('MsegValid', _MSEG_VALID_LENGTH, FIELD_UINT),
+        ('SinitHash', _SINIT_HASH_LENGTH, FIELD_BYTES),
+        ('MleHash', _MLE_HASH_LENGTH, FIELD_BYTES),
+        ('StmHash', _STM_HASH_LENGTH, FIELD_BYTES),
+        ('LcpPolicyHash', _LCP_POLICY_HASH_LENGTH, FIELD_BYTES),
+        ('PolicyControl', _POLICY_CONTROL_LENGTH, FIELD_UINT),
+        ('RlpWakeupAddr', _RLP_WAKEUP_ADDR_LENGTH, FIELD_UINT),
+        ('Reserved', _RESERVED_LENGTH, FIELD_UINT),
+        ('NumSinitMdrs', _NUMBER_SINIT_MDRS_LENGTH, FIELD_UINT),
+        ('SinitMdrTableOffset', _SINIT_MDR_TABLE_OFFSET_LENGTH, FIELD_UINT),
+        ('SinitVtdDmarTableSize', _SINIT_VTD_DMAR_TABLE_SIZE_LENGTH, FIELD_UINT),
+        ('SinitVtdDmarTableOffset', _SINIT_VTD_DMAR_TABLE_OFFSET_LENGTH, FIELD_UINT),
+        ))
+    _LAYOUT_V8 = _LAYOUT_V5.extend ('sinitMleDataV8', (
+        ('ProcScrtmStatus', _PROCESSOR_SCRTM_STATUS_LENGTH, FIELD_UINT),
+        ))
+    _LAYOUTS = { 5 : _LAYOUT_V5, 8 : _LAYOUT_V8 }
+    _LAYOUT = _LAYOUT_V8
     def __init__(self, pbytes):
         super (sinitMleData, self).__init__ (None, str (pbytes))
+    def _Layout (self):
+        return _versioned_layout (self._LAYOUTS, self._read_uint (self._VERSION_OFFSET, self._VERSION_LENGTH))
     def Bytes (self):
         return self._read_bytes (self._VERSION_OFFSET, self._PROCESSOR_SCRTM_STATUS_OFFSET + self._PROCESSOR_SCRTM_STATUS_LENGTH)
     def Version (self):
-        return self._read_uint (self._VERSION_OFFSET, self._VERSION_LENGTH)
+        return self._field ('Version')
     def BiosAcmId (self):
-        return self._read_bytes (self._BIOS_ACM_ID_OFFSET, self._BIOS_ACM_ID_LENGTH)
+        return bytearray (self._field ('BiosAcmId'))
     def EdxSenterFlags (self):
-        return self._read_uint (self._EDX_SENTER_FLAGS_OFFSET, self._EDX_SENTER_FLAGS_LENGTH)
+        return self._field ('EdxSenterFlags')
     def MsegValid (self):
-        return self._read_uint (self._MSEG_VALID_OFFSET, self._MSEG_VALID_LENGTH)
+        return self._field ('MsegValid')
     def MsegValid_Bytes (self):
         return self._read_bytes (self._MSEG_VALID_OFFSET, self._MSEG_VALID_LENGTH)
     def SinitHash (self):
-        return self._read_bytes (self._SINIT_HASH_OFFSET, self._SINIT_HASH_LENGTH)
+        return bytearray (self._field ('SinitHash'))
     def MleHash (self):
-        return self._read_bytes (self._MLE_HASH_OFFSET, self._MLE_HASH_LENGTH)
+        return bytearray (self._field ('MleHash'))
     def StmHash (self):
-        return self._read_bytes (self._STM_HASH_OFFSET, self._STM_HASH_LENGTH)
+        return bytearray (self._field ('StmHash'))
     def LcpPolicyHash (self):
-        return self._read_bytes (self._LCP_POLICY_HASH_OFFSET, self._LCP_POLICY_HASH_LENGTH)
+        return bytearray (self._field ('LcpPolicyHash'))
     def PolicyControl (self):
-        return self._read_uint (self._POLICY_CONTROL_OFFSET, self._POLICY_CONTROL_LENGTH)
+        return self._field ('PolicyControl')
     def PolicyControl_Bytes (self):
         return self._read_bytes (self._POLICY_CONTROL_OFFSET, self._POLICY_CONTROL_LENGTH)
     def RlpWakeupAddr (self):
-        return self._read_uint (self._RLP_WAKEUP_ADDR_OFFSET, self._RLP_WAKEUP_ADDR_LENGTH)
+        return self._field ('RlpWakeupAddr')
     def Reserved (self):
-        return self._read_uint (self._RESERVED_OFFSET, self._RESERVED_LENGTH)
+        return self._field ('Reserved')
     def NumSinitMdrs (self):
-        return self._read_uint (self._NUMBER_SINIT_MDRS_OFFSET, self._NUMBER_SINIT_MDRS_LENGTH)
+        return self._field ('NumSinitMdrs')
     def SinitMdrTableOffset (self):
-        return self._read_uint (self._SINIT_MDR_TABLE_OFFSET_OFFSET, self._SINIT_MDR_TABLE_OFFSET_LENGTH)
+        return self._field ('SinitMdrTableOffset')
     def SinitVtdDmarTableSize (self):
-        return self._read_uint (self._SINIT_VTD_DMAR_TABLE_SIZE_OFFSET, self._SINIT_VTD_DMAR_TABLE_SIZE_LENGTH)
+        return self._field ('SinitVtdDmarTableSize')
     def SinitVtdDmarTableOffset (self):
-        return self._read_uint (self._SINIT_VTD_DMAR_TABLE_OFFSET_OFFSET, self._SINIT_VTD_DMAR_TABLE_OFFSET_LENGTH)
+        return self._field ('SinitVtdDmarTableOffset')
     def ProcScrtmStatus (self):
-        return self._read_uint (self._PROCESSOR_SCRTM_STATUS_OFFSET, self._PROCESSOR_SCRTM_STATUS_LENGTH)
+        return self._field ('ProcScrtmStatus')
     def ProcScrtmStatus_Bytes (self):
         return self._read_bytes (self._PROCESSOR_SCRTM_STATUS_OFFSET, self._PROCESSOR_SCRTM_STATUS_LENGTH)
 
@@ -476,34 +734,210 @@ class osSinitData (binParse):
     _CAPABILITIES_LENGTH = 4
     _EFI_RSDT_POINTER_OFFSET = _CAPABILITIES_OFFSET + _CAPABILITIES_LENGTH
     _EFI_RSDT_POINTER_LENGTH = 8
+    # table layouts by version, later versions append fields
+    _LAYOUT_V4 = recordLayout ('osSinitDataV4', (
+        ('Version', _VERSION_LENGTH, FIELD_UINT),
+        ('Reserved', _RESERVED_LENGTH, FIELD_UINT),
+        ('MlePageTableBase', _MLE_PAGETABLE_BASE_LENGTH, FIELD_UINT),
+        ('MleSize', _MLE_SIZE_LENGTH, FIELD_UINT),
+        ('MleHeaderBase', _MLE_HEADER_BASE_LENGTH, FIELD_UINT),
+        ('PmrLowBase', _PMR_LOW_BASE_LENGTH, FIELD_UINT),
+        ('PmrLowSize', _PMR_LOW_SIZE_LENGTH, FIELD_UINT),
+        ('PmrHighBase', _PMR_HIGH_BASE_LENGTH, FIELD_UINT),
+        ('PmrHighSize', _PMR_HIGH_SIZE_LENGTH, FIELD_UINT),
+        ('LcpPoBase', _LCP_PO_BASE_LENGTH, FIELD_UINT),
+        ('LcpPoSize', _LCP_PO_SIZE_LENGTH, FIELD_UINT),
+        ('Capabilities', _CAPABILITIES_LENGTH, FIELD_UINT),
+        ))
+    _LAYOUT_V5 = _LAYOUT_V4.extend ('osSinitDataV5', (
+        ('EfiRsdtPointer', _EFI_RSDT_POINTER_LENGTH, FIELD_UINT),
+        ))
+    _LAYOUTS = { 4 : _LAYOUT_V4, 5 : _LAYOUT_V5 }
+    _LAYOUT = _LAYOUT_V5
     def __init__(self, pbytes):
         super (osSinitData, self).__init__ (None, str (pbytes))
+    def _Layout (self):
+        return _versioned_layout (self._LAYOUTS, self._read_uint (self._VERSION_OFFSET, self._VERSION_LENGTH))
     def Version (self):
-        return self._read_uint (self._VERSION_OFFSET, self._VERSION_LENGTH)
+        return self._field ('Version')
     def MlePageTableBase (self):
-        return self._read_uint (self._MLE_PAGETABLE_BASE_OFFSET, self._MLE_PAGETABLE_BASE_LENGTH)
+        return self._field ('MlePageTableBase')
     def MleSize (self):
-        return self._read_uint (self._MLE_SIZE_OFFSET, self._MLE_SIZE_LENGTH)
+        return self._field ('MleSize')
     def MleHeaderBase (self):
-        return self._read_uint (self._MLE_HEADER_BASE_OFFSET, self._MLE_HEADER_BASE_LENGTH)
+        return self._field ('MleHeaderBase')
     def PmrLowBase (self):
-        return self._read_uint (self._PMR_LOW_BASE_OFFSET, self._PMR_LOW_BASE_LENGTH)
+        return self._field ('PmrLowBase')
     def PmrLowSize (self):
-        return self._read_uint (self._PMR_LOW_SIZE_OFFSET, self._PMR_LOW_SIZE_LENGTH)
+        return self._field ('PmrLowSize')
     def PmrHighBase (self):
-        return self._read_uint (self._PMR_HIGH_BASE_OFFSET, self._PMR_HIGH_BASE_LENGTH)
+        return self._field ('PmrHighBase')
     def PmrHighSize (self):
-        return self._read_uint (self._PMR_HIGH_SIZE_OFFSET, self._PMR_HIGH_SIZE_LENGTH)
+        return self._field ('PmrHighSize')
     def LcpPoBase (self):
-        return self._read_uint (self._LCP_PO_BASE_OFFSET, self._LCP_PO_BASE_LENGTH)
+        return self._field ('LcpPoBase')
     def LcpPoSize (self):
-        return self._read_uint (self._LCP_PO_SIZE_OFFSET, self._LCP_PO_SIZE_LENGTH)
+        return self._field ('LcpPoSize')
     def Capabilities (self):
-        return self._read_uint (self._CAPABILITIES_OFFSET, self._CAPABILITIES_LENGTH)
+        return self._field ('Capabilities')
     def Capabilities_Bytes (self):
         return self._read_bytes (self._CAPABILITIES_OFFSET, self._CAPABILITIES_LENGTH)
     def EfiRsdtPointer (self):
-        return self._read_uint (self._EFI_RSDT_POINTER_OFFSET, self._EFI_RSDT_POINTER_LENGTH)
+        return self._field ('EfiRsdtPointer')
+
+heapSnapshotInfo = collections.namedtuple ('heapSnapshotInfo', ('path', 'host', 'timestamp', 'sinit_mle_version',
+                                                             'os_sinit_version', 'heap_length', 'sections'))
+
+def _align (offset, granule):
+    return (offset + granule - 1) // granule * granule
+
+class heapSnapshot (mapParse):
+    ''' archived TXT heap: a header, the section table, then the registers
+    and the heap at page aligned offsets so both can be mapped '''
+    MAGIC = 'TXTHEAP\x00'
+    _FORMAT_VERSION = 1
+    _HOST_LENGTH = 64
+    _LAYOUT = recordLayout ('heapSnapshotHeader', (
+        ('Magic', len (MAGIC), FIELD_BYTES),
+        ('FormatVersion', 4, FIELD_UINT),
+        ('NumSections', 4, FIELD_UINT),
+        ('Host', _HOST_LENGTH, FIELD_BYTES),
+        ('Timestamp', 8, FIELD_UINT),
+        ('SinitMleVersion', 4, FIELD_UINT),
+        ('OsSinitVersion', 4, FIELD_UINT),
+        ('RegsOffset', 8, FIELD_UINT),
+        ('RegsLength', 8, FIELD_UINT),
+        ('HeapOffset', 8, FIELD_UINT),
+        ('HeapLength', 8, FIELD_UINT),
+        ('Checksum', 32, FIELD_BYTES),
+        ))
+    _SECTION = recordLayout ('heapSnapshotSection', (
+        ('Offset', 8, FIELD_UINT),
+        ('Length', 8, FIELD_UINT),
+        ))
+    _TABLE_OFFSET = _LAYOUT.size
+    _NUM_SECTIONS = len (txtHeap._SECTIONS)
+    HEADER_SIZE = _TABLE_OFFSET + _NUM_SECTIONS * _SECTION.size
+    def __init__ (self, pfile, pmmap=False):
+        self._mmap = pmmap
+        super (heapSnapshot, self).__init__ (pfile, pmmap)
+        if self._file_size < self.HEADER_SIZE or self._fields ().Magic != self.MAGIC:
+            raise IOError ('{0} is not a TXT heap snapshot'.format (getattr (pfile, 'name', 'file')))
+        _rec = self._fields ()
+        if _rec.FormatVersion != self._FORMAT_VERSION:
+            raise IOError ('unsupported TXT heap snapshot version {0}'.format (_rec.FormatVersion))
+        for _name, _offset, _length in (('registers', _rec.RegsOffset, _rec.RegsLength),
+                                        ('heap', _rec.HeapOffset, _rec.HeapLength)):
+            if _length and _offset + _length > self._file_size:
+                raise IOError ('TXT heap snapshot {0} of size {1:#x} at offset {2:#x} is past the end of the file'.format (_name, _length, _offset))
+            if _length and pmmap and _offset % mmap.ALLOCATIONGRANULARITY:
+                raise IOError ('TXT heap snapshot {0} at offset {1:#x} can not be mapped'.format (_name, _offset))
+        for _section in self.Sections ():
+            if _section.offset + _section.length > _rec.HeapLength:
+                raise IOError ('TXT heap snapshot section at offset {0:#x} does not fit the heap'.format (_section.offset))
+    @classmethod
+    def _ParseTable (cls, buf, count):
+        return tuple (heapSection (*cls._SECTION.unpack_from (buf, cls._TABLE_OFFSET + _index * cls._SECTION.size))
+                      for _index in xrange (count))
+    def Host (self):
+        return self._fields ().Host.rstrip ('\x00')
+    def Timestamp (self):
+        return self._fields ().Timestamp
+    def SinitMleVersion (self):
+        return self._fields ().SinitMleVersion
+    def OsSinitVersion (self):
+        return self._fields ().OsSinitVersion
+    def HeapLength (self):
+        return self._fields ().HeapLength
+    def Checksum (self):
+        return self._fields ().Checksum
+    def Sections (self):
+        return self._ParseTable (str (self._read_view (0, self.HEADER_SIZE)), self._fields ().NumSections)
+    def Heap (self):
+        return txtHeap (self._file, self._mmap, self._fields ().HeapOffset, self._fields ().HeapLength, self.Sections ())
+    def PubConfRegs (self):
+        if not self._fields ().RegsLength:
+            return None
+        return pubConfRegsParse (self._file, self._mmap, poffset=self._fields ().RegsOffset)
+    def Verify (self):
+        _hash = hashlib.sha256 ()
+        _rec = self._fields ()
+        for _offset, _length in ((_rec.RegsOffset, _rec.RegsLength), (_rec.HeapOffset, _rec.HeapLength)):
+            if _length:
+                _hash.update (self._read_view (_offset, _length))
+        return _hash.digest () == _rec.Checksum
+
+def write_heap_snapshot (fobj, heap, regs=None, host='', timestamp=None):
+    _granule = mmap.ALLOCATIONGRANULARITY
+    _regs = str (regs.Bytes ()) if regs is not None else ''
+    _heap = str (heap.Bytes ())
+    _sections = heap.Sections ()
+    _regs_offset = _align (heapSnapshot.HEADER_SIZE, _granule) if _regs else 0
+    _heap_offset = _align (max (heapSnapshot.HEADER_SIZE, _regs_offset + len (_regs)), _granule)
+    _checksum = hashlib.sha256 (_regs)
+    _checksum.update (_heap)
+    _header = heapSnapshot._LAYOUT.struct.pack (
+        heapSnapshot.MAGIC, heapSnapshot._FORMAT_VERSION, len (_sections),
+        str (host) [:heapSnapshot._HOST_LENGTH],
+        int (time.time ()) if timestamp is None else timestamp,
+        sinitMleData (heap.SinitMleData ()).Version (), osSinitData (heap.OsSinitData ()).Version (),
+        _regs_offset, len (_regs), _heap_offset, len (_heap), _checksum.digest ())
+    _table = ''.join (heapSnapshot._SECTION.struct.pack (*_section) for _section in _sections)
+    _out = (_header + _table).ljust (_regs_offset or _heap_offset, '\x00')
+    if _regs:
+        _out = (_out + _regs).ljust (_heap_offset, '\x00')
+    fobj.write (_out)
+    fobj.write (_heap)
+
+def scan_heap_snapshots (directory):
+    ''' heapSnapshotInfo for every snapshot in directory, sorted by name '''
+    _layout = heapSnapshot._LAYOUT
+    for _name in sorted (os.listdir (directory)):
+        _path = os.path.join (directory, _name)
+        if not os.path.isfile (_path):
+            continue
+        with open (_path, 'rb') as _fobj:
+            _data = _fobj.read (heapSnapshot.HEADER_SIZE)
+        if len (_data) < heapSnapshot.HEADER_SIZE or not _data.startswith (heapSnapshot.MAGIC):
+            continue
+        _rec = _layout.unpack_from (_data)
+        if _rec.FormatVersion != heapSnapshot._FORMAT_VERSION:
+            continue
+        yield heapSnapshotInfo (_path, _rec.Host.rstrip ('\x00'), _rec.Timestamp, _rec.SinitMleVersion,
+                                _rec.OsSinitVersion, _rec.HeapLength,
+                                heapSnapshot._ParseTable (_data, min (_rec.NumSections, heapSnapshot._NUM_SECTIONS)))
+
+def open_snapshot (fobj, pmmap=False, verify=True):
+    _snapshot = heapSnapshot (fobj, pmmap)
+    if verify and not _snapshot.Verify ():
+        raise IOError ('{0}: TXT heap snapshot checksum does not match'.format (getattr (fobj, 'name', 'file')))
+    return _snapshot
+
+def open_heap (fobj, pmmap=False, verify=True):
+    ''' txtHeap over fobj, a heap snapshot or a raw heap '''
+    fobj.seek (0)
+    _magic = fobj.read (len (heapSnapshot.MAGIC))
+    fobj.seek (0)
+    if _magic == heapSnapshot.MAGIC:
+        return open_snapshot (fobj, pmmap, verify).Heap ()
+    fobj.seek (0, 2)
+    _size = fobj.tell ()
+    fobj.seek (0)
+    return txtHeap (fobj, pmmap, 0, _size)
+
+# tboot policy values, from tboot's tb_policy.h (see lcp-def.c)
+TB_POLTYPE_CONT_NON_FATAL = 0
+TB_POLTYPE_CONT_VERIFY_FAIL = 1
+TB_POLTYPE_HALT = 2
+TB_HTYPE_ANY = 0
+TB_HTYPE_IMAGE = 1
+TB_HALG_SHA1 = 0
+TB_POL_MOD_NUM_ANY = 129
+TB_POL_PCR_NONE = 255
+TB_POLCTL_EXTEND_PCR17 = 0x1
+
+# bytes in each tb_hash_t of a policy entry, by the policy's hash_alg
+_TB_HASH_SIZE = { TB_HALG_SHA1 : 20 }
 
 class polEntry (binParse):
     _MOD_NUM_OFFSET = 0
@@ -517,20 +951,44 @@ class polEntry (binParse):
     _NUM_HASHES_OFFSET = _RESERVED_OFFSET + _RESERVED_LENGTH
     _NUM_HASHES_LENGTH = 1
     _HASHES_OFFSET = _NUM_HASHES_OFFSET + _NUM_HASHES_LENGTH
-    def __init__(self, pbytes):
+    _LAYOUT = recordLayout ('tbPolicyEntry', (
+        ('ModNum', _MOD_NUM_LENGTH, FIELD_UINT),
+        ('Pcr', _PCR_LENGTH, FIELD_UINT),
+        ('HashType', _HASH_TYPE_LENGTH, FIELD_UINT),
+        ('Reserved', _RESERVED_LENGTH, FIELD_UINT),
+        ('NumHashes', _NUM_HASHES_LENGTH, FIELD_UINT),
+        ))
+    def __init__(self, pbytes, hash_size=_TB_HASH_SIZE [TB_HALG_SHA1], poffset=0):
         super (polEntry, self).__init__ (None, str (pbytes))
+        self._record_offset = poffset
+        self._hash_size = hash_size
+        # the header first, Size () reads NumHashes from it
+        if len (self._filemmap) < poffset + self._HASHES_OFFSET:
+            raise ValueError ('tboot policy entry header truncated')
+        if len (self._filemmap) < poffset + self.Size ():
+            raise ValueError ('tboot policy entry truncated')
     def ModNum (self):
-        return self._read_uint (self._MOD_NUM_OFFSET, self._MOD_NUM_LENGTH)
+        return self._fields ().ModNum
     def Pcr (self):
-        return self._read_uint (self._PCR_OFFSET, self. _PCR_LENGTH)
+        return self._fields ().Pcr
     def HashType (self):
-        return self._read_uint (self._HASH_TYPE_OFFSET, self._HASH_TYPE_LENGTH)
+        return self._fields ().HashType
     def Reserved (self):
-        return self._read_uint (self._RESERVED_OFFSET, self._RESERVED_LENGTH)
+        return self._fields ().Reserved
     def NumHashes (self):
-        return self._read_uint (self._NUM_HASHES_OFFSET, self._NUM_HASHES_LENGTH)
-    def Hases (self):
-        return 0
+        return self._fields ().NumHashes
+    def Size (self):
+        return self._HASHES_OFFSET + self.NumHashes () * self._hash_size
+    def Hashes (self):
+        _start = self._record_offset + self._HASHES_OFFSET
+        _end = self._record_offset + self.Size ()
+        return tuple (self._filemmap [_offset:_offset + self._hash_size]
+                      for _offset in xrange (_start, _end, self._hash_size))
+
+# what a policy entry says about one module: the PCR its measurement is
+# extended into (TB_POL_PCR_NONE for none), TB_HTYPE_* and the frozenset
+# of allowed hashes
+modulePolicy = collections.namedtuple ('modulePolicy', ('pcr', 'hash_type', 'hashes'))
 
 class launchCtrlPol (mapParse):
     _VERSION_OFFSET = 0
@@ -546,28 +1004,81 @@ class launchCtrlPol (mapParse):
     _NUM_ENTRIES_OFFSET = _RESERVED_OFFSET + _RESERVED_LENGTH
     _NUM_ENTRIES_LENGTH = 1
     _ENTRIES_OFFSET = _NUM_ENTRIES_OFFSET + _NUM_ENTRIES_LENGTH
+    _LAYOUT = recordLayout ('tbPolicy', (
+        ('Version', _VERSION_LENGTH, FIELD_UINT),
+        ('PolicyType', _POLICY_TYPE_LENGTH, FIELD_UINT),
+        ('HashAlg', _HASH_ALG_LENGTH, FIELD_UINT),
+        ('PolicyControl', _POLICY_CONTROL_LENGTH, FIELD_UINT),
+        ('Reserved', _RESERVED_LENGTH, FIELD_UINT),
+        ('NumEntries', _NUM_ENTRIES_LENGTH, FIELD_UINT),
+        ))
     _TB_POLCTL_EXTEND_PCR17 = 0x1  # extend policy into PCR 17
     _TB_POLCTL_EXTEND_PCR17_OSSINITCAPS = 0x2 # extend OsSinit.Capabilities into PCR 17
     def __init__ (self, pfile, pmmap=False):
         super (launchCtrlPol, self).__init__ (pfile, pmmap)
+        self._entries = None
+        self._modules = None
     def Bytes (self):
         return self._read_bytes (self._VERSION_OFFSET, self._file_size)
     def Version (self):
-        return self._read_uint (self._VERSION_OFFSET, self._VERSION_LENGTH)
+        return self._fields ().Version
     def PolicyType (self):
-        return self._read_uint (self._POLICY_TYPE_OFFSET, self._POLICY_TYPE_OFFSET)
+        return self._fields ().PolicyType
     def HashAlg (self):
-        return self._read_uint (self._HASH_ALG_OFFSET, self._HASH_ALG_LENGTH)
+        return self._fields ().HashAlg
     def PolicyControl (self):
-        return self._read_uint (self._POLICY_CONTROL_OFFSET, self._POLICY_CONTROL_LENGTH)
+        return self._fields ().PolicyControl
     def PolicyControl_Bytes (self):
         return self._read_bytes (self._POLICY_CONTROL_OFFSET, self._POLICY_CONTROL_LENGTH)
     def Reserved (self):
-        return self._read_uint (self._RESERVED_OFFSET, self._RESERVED_LENGTH)
+        return self._fields ().Reserved
     def NumEntries (self):
-        return self._read_uint (self._NUM_ENTRIES_OFFSET, self._NUM_ENTRIES_LENGTH)
-    def Entries (self):
+        return self._fields ().NumEntries
+    def Entries_Bytes (self):
         return self._read_bytes (self._ENTRIES_OFFSET, self._file_size - self._ENTRIES_OFFSET)
+    def Entries (self):
+        ''' raises ValueError for a truncated policy or an unknown HashAlg '''
+        if self._entries is None:
+            _data = self._read_bytes_raw (self._ENTRIES_OFFSET, self._file_size - self._ENTRIES_OFFSET)
+            _hash_size = _TB_HASH_SIZE.get (self.HashAlg ())
+            _entries = []
+            _offset = 0
+            for _index in xrange (self.NumEntries ()):
+                _entry = polEntry (_data, _hash_size or 0, _offset)
+                if _entry.NumHashes () and _hash_size is None:
+                    raise ValueError ('unknown tboot policy hash_alg: {0}'.format (self.HashAlg ()))
+                _entries.append (_entry)
+                _offset += _entry.Size ()
+            self._entries = tuple (_entries)
+        return self._entries
+    def _ModuleMap (self):
+        # tboot takes the first entry matching the module number or
+        # TB_POL_MOD_NUM_ANY, so numbers listed after an ANY entry never
+        # get their own
+        if self._modules is None:
+            _modules = dict ()
+            _any = None
+            for _entry in self.Entries ():
+                _policy = modulePolicy (_entry.Pcr (), _entry.HashType (), frozenset (_entry.Hashes ()))
+                if _entry.ModNum () == TB_POL_MOD_NUM_ANY:
+                    _any = _policy
+                    break
+                _modules.setdefault (_entry.ModNum (), _policy)
+            self._modules = (_modules, _any)
+        return self._modules
+    def ModulePolicy (self, mod_num):
+        _modules, _any = self._ModuleMap ()
+        return _modules.get (mod_num, _any)
+    def ModulePcr (self, mod_num):
+        _policy = self.ModulePolicy (mod_num)
+        if _policy is None or _policy.pcr == TB_POL_PCR_NONE:
+            return None
+        return _policy.pcr
+    def ModuleAllowed (self, mod_num, digest):
+        _policy = self.ModulePolicy (mod_num)
+        if _policy is None:
+            return False
+        return _policy.hash_type == TB_HTYPE_ANY or str (digest) in _policy.hashes
     def ExtendPCR17_LCP (self):
         if self.PolicyControl () & self._TB_POLCTL_EXTEND_PCR17:
             return True
@@ -578,19 +1089,61 @@ class launchCtrlPol (mapParse):
             return True
         else:
             return False
-        
+
+def policy_bytes (entries, policy_control=TB_POLCTL_EXTEND_PCR17, policy_type=TB_POLTYPE_CONT_NON_FATAL,
+                  hash_alg=TB_HALG_SHA1):
+    ''' tb_policy_t with entries of (mod_num, pcr, hash_type, hashes) '''
+    _parts = [launchCtrlPol._LAYOUT.struct.pack (2, policy_type, hash_alg, policy_control, 0, len (entries))]
+    for _mod_num, _pcr, _hash_type, _hashes in entries:
+        _parts.append (polEntry._LAYOUT.struct.pack (_mod_num, _pcr, _hash_type, 0, len (_hashes)))
+        _parts.extend (_hashes)
+    return ''.join (_parts)
+
+def default_policy (pcr=19):
+    ''' tboot's built in policy, modules after the first extended into pcr '''
+    _entries = ((0, TB_POL_PCR_NONE, TB_HTYPE_ANY, ()),
+                (TB_POL_MOD_NUM_ANY, pcr, TB_HTYPE_ANY, ()))
+    return launchCtrlPol (cStringIO.StringIO (policy_bytes (_entries)))
+
+def read_policy (path):
+    ''' default_policy () when path is empty '''
+    if not path:
+        return default_policy ()
+    with open (path, 'rb') as _fobj:
+        return launchCtrlPol (cStringIO.StringIO (_fobj.read ()))
+
+def policy_modules (policy, modules, pcr):
+    ''' the (cmdline, module) pairs policy extends into pcr, in order '''
+    if policy is None:
+        policy = default_policy ()
+    return [_module for _num, _module in enumerate (modules) if policy.ModulePcr (_num) == pcr]
+
+# bytes per hex dump row and rows formatted per binascii call
+HEX_ROW_BYTES = 16
+_HEX_BLOCK_ROWS = 4096
+
+def hex_rows (data):
+    ''' 16 bytes per row in groups of two, as write_hex prints them '''
+    _length = len (data)
+    if not _length:
+        yield ''
+        return
+    _block = HEX_ROW_BYTES * _HEX_BLOCK_ROWS
+    # a row is 8 groups of 4 hex digits and a space
+    _row = HEX_ROW_BYTES // 2 * 5
+    for _start in xrange (0, _length, _block):
+        _hex = binascii.hexlify (data [_start : _start + _block])
+        _text = ' '.join ([_hex [_i : _i + 4] for _i in xrange (0, len (_hex), 4)])
+        if len (_hex) % 4 == 0:
+            _text += ' '
+        for _i in xrange (0, len (_text), _row):
+            yield _text [_i : _i + _row]
+
+def write_hex (outfile, data, prefix='    '):
+    outfile.writelines (prefix + _row + '\n' for _row in hex_rows (data))
+
 def pp_bytearray(pbytearray):
-    printbuf = list ()
-    printbuf.append (str ())
-    bytecount = 0
-    for byte in pbytearray:
-        bytecount += 1
-        printbuf[-1] += '{0:0{1}x}'.format (byte, 2)
-        if (bytecount % 2) == 0:
-            printbuf[-1] += ' '
-        if (bytecount % 16) == 0 and bytecount < len (pbytearray):
-            printbuf.append (str ())
-    return printbuf
+    return list (hex_rows (pbytearray))
 
 def pp_acmFlags (flags):
     print "  Flags raw:      {0}".format (flags.Raw ())
@@ -619,23 +1172,18 @@ def pp_ACM (acm):
     print "  SegSel:         {0}".format (acm.SegSel ())
     print "  EntryPoint:     {0}".format (acm.EntryPoint ())
     print "  Reserved2:"
-    for _bytestr in pp_bytearray (acm.Reserved2 ()):
-        print "    {0}".format (_bytestr)
+    write_hex (sys.stdout, acm.Reserved2 ())
     print "  KeySize:        {0}".format (acm.KeySize ())
     print "  ScratchSize:    {0}".format (acm.ScratchSize ())
     print "  RSAPubKey:"
-    for _bytestr in pp_bytearray (acm.RSAPubKey ()):
-        print "    {0}".format (_bytestr)
+    write_hex (sys.stdout, acm.RSAPubKey ())
     print "  RSAPubExp:      {0}".format (acm.RSAPubExp ())
     print "  RSASig:"
-    for _bytestr in pp_bytearray (acm.RSASig ()):
-        print "    {0}".format (_bytestr)
+    write_hex (sys.stdout, acm.RSASig ())
     print "  Scratch:"
-    for _bytestr in pp_bytearray (acm.Scratch ()):
-        print "    {0}".format (_bytestr)
+    write_hex (sys.stdout, acm.Scratch ())
     print "  UserArea:"
-    for _bytestr in pp_bytearray (acm.UserArea ()):
-        print "    {0}".format (_bytestr)
+    write_hex (sys.stdout, acm.UserArea ())
 
 def pp_PubConfRegs (regs):
     print 'TXT Public Config Registers:'
@@ -652,8 +1200,7 @@ def pp_PubConfRegs (regs):
     print '  HeapSize:       {0:#0{1}x}'.format (regs.HeapSize (), regs._REG_SIZE * 2 + 2)
     print '  DMAProtected:   {0:#0{1}x}'.format (regs.HeapSize (), regs._REG_SIZE * 2 + 2)
     print '  PublicKey:'
-    for _bytestr in pp_bytearray (regs.PublicKey_Bytes ()):
-        print "    {0}".format (_bytestr)
+    write_hex (sys.stdout, regs.PublicKey_Bytes ())
     print '  ExtErrorStatus: {0:#0{1}x}'.format (regs.ExtErrorStatus (), regs._REG_SIZE * 2 + 2)
 
 def pp_TxtHeap (heap):
@@ -667,22 +1214,17 @@ def pp_SinitToMle (sinitMle):
     print 'SINIT to MLE Data:'
     print '  Version:                 {0:#0{1}x}'.format (sinitMle.Version (), sinitMle._VERSION_LENGTH * 2 + 2)
     print '  BiosAcmId:'
-    for _bytestr in pp_bytearray (sinitMle.BiosAcmId ()):
-        print '    {0}'.format (_bytestr)
+    write_hex (sys.stdout, sinitMle.BiosAcmId ())
     print '  EdxSenterFlags:          {0:#0{1}x}'.format (sinitMle.EdxSenterFlags (), sinitMle._EDX_SENTER_FLAGS_LENGTH * 2 + 2)
     print '  MsegValid:               {0:#0{1}x}'.format (sinitMle.MsegValid (), sinitMle._MSEG_VALID_LENGTH * 2 + 2)
     print '  SinitHash:'
-    for _bytestr in pp_bytearray (sinitMle.SinitHash ()):
-        print '    {0}'.format (_bytestr)
+    write_hex (sys.stdout, sinitMle.SinitHash ())
     print '  MleHash:'
-    for _bytestr in pp_bytearray (sinitMle.MleHash ()):
-        print '    {0}'.format (_bytestr)
+    write_hex (sys.stdout, sinitMle.MleHash ())
     print '  StmHash:'
-    for _bytestr in pp_bytearray (sinitMle.StmHash ()):
-        print '    {0}'.format (_bytestr)
+    write_hex (sys.stdout, sinitMle.StmHash ())
     print '  LcpPolicyHash:'
-    for _bytestr in pp_bytearray (sinitMle.LcpPolicyHash ()):
-        print '    {0}'.format (_bytestr)
+    write_hex (sys.stdout, sinitMle.LcpPolicyHash ())
     print '  PolicyControl:           {0:#0{1}x}'.format (sinitMle.PolicyControl (), sinitMle._POLICY_CONTROL_LENGTH * 2 + 2)
     print '  RlpWakeupAddr:           {0:#0{1}x}'.format (sinitMle.RlpWakeupAddr (), sinitMle._RLP_WAKEUP_ADDR_LENGTH * 2 + 2)
     print '  Reserved:                {0:#0{1}x}'.format (sinitMle.Reserved (), sinitMle._RESERVED_LENGTH * 2 + 2)
@@ -708,16 +1250,405 @@ def pp_OsToSinit (os_sinit):
     print '  EfiRsdtPointer:   {0:#0{1}x}'.format (os_sinit.EfiRsdtPointer (), os_sinit._EFI_RSDT_POINTER_LENGTH * 2 + 2)
 
 class pcrEmu(object):
-    def __init__(self):
-        self._value = base64.b16decode(''.join('00' for x in range (0, hashlib.sha1 ().digest_size)))
+    ''' one PCR over one or more banks, the first is the default; a
+    measurement is a string for it or a dict by algorithm '''
+    def __init__(self, algs=('sha1',), initial=None):
+        self._algs = tuple (algs)
+        self._values = dict ()
+        self._log = dict ()
+        for _alg in self._algs:
+            _size = hashlib.new (_alg).digest_size
+            self._values [_alg] = str ((initial or {}).get (_alg, '\x00' * _size))
+            self._log [_alg] = (bytearray (), array.array ('L'), array.array ('L'))
+        self._initial = dict (self._values)
+        self._events = 0
+    def algs(self):
+        return self._algs
+    def __len__(self):
+        return self._events
+    def _measurements(self, something):
+        if isinstance (something, dict):
+            return something.iteritems ()
+        return ((self._algs [0], something),)
     def extend(self,something):
-        _sha1 = hashlib.sha1 ()
-        _sha1.update(self._value + something)
-        self._value = _sha1.digest ()
-    def read(self):
-        return self._value
-    def hexread(self):
-        return self._value.encode("hex")
+        self.extend_many ((something,))
+    def extend_many(self, measurements):
+        _values = self._values
+        _log = self._log
+        for something in measurements:
+            for _alg, _value in self._measurements (something):
+                if _alg not in _values:
+                    raise ValueError ('no {0} bank in this PCR'.format (_alg))
+                _hash = hashlib.new (_alg, _values [_alg])
+                _hash.update (_value)
+                _values [_alg] = _hash.digest ()
+                _data, _ends, _events = _log [_alg]
+                _data.extend (_value)
+                _ends.append (len (_data))
+                _events.append (self._events)
+            self._events += 1
+    def log(self, alg=None):
+        _data, _ends, _events = self._log [alg or self._algs [0]]
+        _start = 0
+        for _end, _event in itertools.izip (_ends, _events):
+            yield _event, str (_data [_start:_end])
+            _start = _end
+    def replay(self, index=None, alg=None):
+        ''' bank value after the first index events '''
+        alg = alg or self._algs [0]
+        _value = self._initial [alg]
+        for _event, _extended in self.log (alg):
+            if index is not None and _event >= index:
+                break
+            _hash = hashlib.new (alg, _value)
+            _hash.update (_extended)
+            _value = _hash.digest ()
+        return _value
+    def read(self, alg=None):
+        return self._values [alg or self._algs [0]]
+    def hexread(self, alg=None):
+        return self.read (alg).encode("hex")
+
+def hash_banks (algs, *parts):
+    _digests = dict ()
+    for _alg in algs:
+        _hash = hashlib.new (_alg)
+        for _part in parts:
+            _hash.update (_part)
+        _digests [_alg] = _hash.digest ()
+    return _digests
+
+pcr17Stage = collections.namedtuple ('pcr17Stage', ('name', 'extend', 'parts'))
+
+class pcr17Stages (object):
+    ''' PCR[17] as its ACM, heap and LCP extends, after update () only the
+    stages reading a changed input are recomputed '''
+    # inputs each stage reads, in extend order
+    _STAGES = (('acm', ('acm', 'edx', 'smd', 'banks')),
+               ('heap', ('heap', 'smd', 'extend_caps', 'banks')),
+               ('lcp', ('lcp', 'banks')))
+    def __init__ (self, acm, heap, lcp=None, edx='\x00' * 4, smd=8, extend_caps=None, banks=('sha1',)):
+        self._inputs = dict (acm=acm, heap=heap, lcp=lcp, edx=edx, smd=smd, banks=tuple (banks))
+        self._caps_override = extend_caps
+        self._memo = dict ()
+    def update (self, **inputs):
+        for _name in inputs:
+            if _name != 'extend_caps' and _name not in self._inputs:
+                raise TypeError ('unknown PCR[17] input: {0}'.format (_name))
+        self._caps_override = inputs.pop ('extend_caps', self._caps_override)
+        self._inputs.update (inputs)
+    def _input (self, name):
+        if name == 'extend_caps':
+            if self._caps_override is not None:
+                return bool (self._caps_override)
+            _lcp = self._inputs ['lcp']
+            return bool (_lcp is not None and _lcp.ExtendPCR17_OsSinitCaps ())
+        return self._inputs [name]
+    def stage (self, name):
+        _reads = dict (self._STAGES) [name]
+        _key = tuple (self._input (_name) for _name in _reads)
+        _memo = self._memo.get (name)
+        if _memo is None or _memo [0] != _key:
+            _memo = (_key, getattr (self, '_stage_' + name) (*_key))
+            self._memo [name] = _memo
+        return _memo [1]
+    def stages (self):
+        return [self.stage (_name) for _name, _reads in self._STAGES]
+    def extend_caps (self):
+        return self._input ('extend_caps')
+    def sinit_hash_matches (self):
+        ''' True without a SHA-1 bank to check '''
+        _extend = self.stage ('acm').extend
+        if 'sha1' not in _extend:
+            return True
+        _pcr = pcrEmu (('sha1',))
+        _pcr.extend (_extend ['sha1'])
+        return str (sinitMleData (self._inputs ['heap'].SinitMleData ()).SinitHash ()) == _pcr.read ()
+    def pcr (self):
+        _pcr = pcrEmu (self._inputs ['banks'])
+        _pcr.extend_many (_stage.extend for _stage in self.stages () if _stage.extend is not None)
+        return _pcr
+    def result (self):
+        _extends = [pcrExtend (_stage.name, _stage.extend, _stage.parts)
+                    for _stage in self.stages () if _stage.extend is not None]
+        return pcrResult (17, self.pcr (), _extends, self.sinit_hash_matches ())
+
+    def _stage_acm (self, acm, edx, smd, banks):
+        # smd picks the ACM digest algorithm, not the version acm was opened with
+        _digest = acm.Digest (smd)
+        return pcr17Stage ('acm', hash_banks (banks, _digest, edx),
+                           collections.OrderedDict ((('AcmDigest', _digest), ('EdxSenterFlags', edx))))
+    def _stage_heap (self, heap, smd, extend_caps, banks):
+        _sinit_mle = sinitMleData (heap.SinitMleData ())
+        _parts = collections.OrderedDict ()
+        for _name in ('BiosAcmId', 'MsegValid_Bytes', 'StmHash', 'PolicyControl_Bytes', 'LcpPolicyHash'):
+            _parts [_name] = str (getattr (_sinit_mle, _name) ())
+        if extend_caps:
+            _parts ['Capabilities_Bytes'] = str (osSinitData (heap.OsSinitData ()).Capabilities_Bytes ())
+        else:
+            _parts ['Capabilities_Bytes'] = '\x00' * 4
+        if smd >= 8:
+            _parts ['ProcScrtmStatus_Bytes'] = str (_sinit_mle.ProcScrtmStatus_Bytes ())
+        return pcr17Stage ('heap', hash_banks (banks, *_parts.values ()), _parts)
+    def _stage_lcp (self, lcp, banks):
+        if lcp is None or not lcp.ExtendPCR17_LCP ():
+            return pcr17Stage ('lcp', None, collections.OrderedDict ())
+        _pol_hash = hash_banks (banks, lcp.Bytes ())
+        _polctrl = str (lcp.PolicyControl_Bytes ())
+        _extend = dict ((_alg, hash_banks ((_alg,), _polctrl, _pol_hash [_alg]) [_alg]) for _alg in banks)
+        return pcr17Stage ('lcp', _extend,
+                           collections.OrderedDict ((('PolicyControl_Bytes', _polctrl), ('LcpHash', _pol_hash))))
+
+pcrExtend = collections.namedtuple ('pcrExtend', ('name', 'values', 'parts'))
+# pcr is a pcrEmu holding the final value of every bank and its extend
+# log, extends lists the pcrExtend behind each of them in order,
+# sinit_hash_matches is None for PCRs other than 17
+pcrResult = collections.namedtuple ('pcrResult', ('index', 'pcr', 'extends', 'sinit_hash_matches'))
+
+def senter_flags (edx):
+    ''' the four EDX bytes extended with the ACM hash, as pcr17 -e gives them '''
+    if isinstance (edx, basestring):
+        edx = int (edx, 16)
+    return base64.b16decode ('{0:#0{1}}'.format (edx, 8))
+
+def _input_file (obj):
+    # bytes are wrapped so the parsers can seek and read them
+    if isinstance (obj, (str, bytearray, buffer)):
+        return cStringIO.StringIO (str (obj))
+    return obj
+
+def _can_map (fobj):
+    try:
+        fobj.fileno ()
+    except (AttributeError, IOError, ValueError):
+        return False
+    return True
+
+def _acm_input (acm, smd, cache, use_mmap):
+    if isinstance (acm, acmParse):
+        return acm
+    _file = _input_file (acm)
+    return acmParse (_file, use_mmap and _can_map (_file), smd, cache)
+
+def _heap_input (heap, use_mmap):
+    if heap is None or isinstance (heap, txtHeap):
+        return heap
+    _file = _input_file (heap)
+    return open_heap (_file, use_mmap and _can_map (_file))
+
+def _lcp_input (lcp):
+    if lcp is None or isinstance (lcp, launchCtrlPol):
+        return lcp
+    _file = _input_file (lcp)
+    return launchCtrlPol (_file, _can_map (_file))
+
+def _module_input (cmdline, module, banks, cache):
+    # hashes hash_module_banks already gave for the module are used as is
+    if isinstance (module, dict):
+        return module
+    return hash_module_banks (cmdline, module, banks, cache)
+
+def compute_pcr17 (acm, heap, lcp=None, edx=0, smd=8, banks=('sha1',), cache=None, extend_caps=None, use_mmap=False):
+    ''' acm, heap and lcp may be parsed objects, open files or bytes '''
+    _stages = pcr17Stages (_acm_input (acm, smd, cache, use_mmap), _heap_input (heap, use_mmap),
+                           _lcp_input (lcp), senter_flags (edx), smd, extend_caps, banks)
+    return _stages.result ()
+
+def compute_pcr18 (mle, mle_args, cmdline, module, banks=('sha1',), cache=None):
+    ''' mle is an MLEUtil or an open MLE file, module an open file or
+    its hash_module_banks hashes '''
+    if not isinstance (mle, MLEUtil):
+        mle = MLEUtil (mle_args, mle, cache)
+    _extends = []
+    for _name, _hashes in (('mle', mle.hashes (banks)),
+                           ('module', _module_input (cmdline, module, banks, cache))):
+        _extends.append (pcrExtend (_name, dict ((_alg, _hash.digest ()) for _alg, _hash in _hashes.iteritems ()), None))
+    _pcr = pcrEmu (banks)
+    _pcr.extend_many (_extend.values for _extend in _extends)
+    return pcrResult (18, _pcr, _extends, None)
+
+def compute_pcr19 (modules, banks=('sha1',), cache=None, jobs=1):
+    ''' modules are (cmdline, open file or hashes) pairs, hashed on jobs threads '''
+    def _measure (module):
+        _hashes = _module_input (module [0], module [1], banks, cache)
+        return pcrExtend (getattr (module [1], 'name', None), dict ((_alg, _hash.digest ()) for _alg, _hash in _hashes.iteritems ()), None)
+    if jobs > 1:
+        import multiprocessing.pool
+        _pool = multiprocessing.pool.ThreadPool (jobs)
+        try:
+            _extends = _pool.map (_measure, modules)
+        finally:
+            _pool.close ()
+            _pool.join ()
+    else:
+        _extends = map (_measure, modules)
+    _pcr = pcrEmu (banks)
+    _pcr.extend_many (_extend.values for _extend in _extends)
+    return pcrResult (19, _pcr, _extends, None)
+
+# manifest columns naming the inputs of one host, modules is a list of
+# "commandline,module" pairs: the first is measured into PCR[18] after
+# the MLE, the rest into PCR[19]
+MANIFEST_FIELDS = ('host', 'acm', 'heap', 'lcp', 'mle', 'mle_args', 'modules', 'edx', 'smd')
+
+def read_manifest (fobj, fmt):
+    ''' host dicts from a JSON or CSV manifest '''
+    import csv
+    import json
+    if fmt == 'json':
+        _hosts = json.load (fobj)
+        if isinstance (_hosts, dict):
+            _hosts = _hosts ['hosts']
+    else:
+        _hosts = list (csv.DictReader (fobj))
+        for _host in _hosts:
+            _host ['modules'] = (_host.get ('modules') or '').split ()
+    for _index, _host in enumerate (_hosts):
+        _host.setdefault ('host', str (_index))
+        _host ['modules'] = [_pair.split (',') if isinstance (_pair, basestring) else _pair
+                             for _pair in _host.get ('modules') or []]
+        _host ['edx'] = _host.get ('edx') or '0x0'
+        _host ['smd'] = int (_host.get ('smd') or 8)
+    return _hosts
+
+# TCG event log, PC Client Platform Firmware Profile section 10
+EV_NO_ACTION = 0x3
+EVENT_LOG_CHUNK_SIZE = 64 * 1024
+_TPM_ALG_NAMES = {0x0004 : 'sha1', 0x000b : 'sha256', 0x000c : 'sha384', 0x000d : 'sha512'}
+_SPEC_ID_SIGNATURE = 'Spec ID Event03\x00'
+_EVENT_HEADER = struct.Struct ('<II')
+_EVENT_SHA1_DIGEST = struct.Struct ('<20sI')
+_EVENT_UINT32 = struct.Struct ('<I')
+_EVENT_DIGEST_HEADER = struct.Struct ('<H')
+_SPEC_ID_HEADER = struct.Struct ('<16sIBBBBI')
+_SPEC_ID_ALG = struct.Struct ('<HH')
+
+tcgEvent = collections.namedtuple ('tcgEvent', ('number', 'pcr', 'type', 'digests', 'data'))
+
+class eventLogError (Exception):
+    def __init__ (self, message):
+        self.message = message
+    def __str__ (self):
+        return self.message
+
+class _chunkReader (object):
+    # hands out fixed-size pieces of a stream from one bounded buffer
+    def __init__ (self, fobj, chunk_size):
+        self._fobj = fobj
+        self._chunk_size = chunk_size
+        self._buf = ''
+        self._pos = 0
+    def at_eof (self):
+        if self._pos < len (self._buf):
+            return False
+        self._buf = self._fobj.read (self._chunk_size)
+        self._pos = 0
+        return not self._buf
+    def take (self, length):
+        # returns (buffer, offset) with length bytes available at offset
+        if len (self._buf) - self._pos < length:
+            self._buf = self._buf [self._pos:] + self._fobj.read (max (self._chunk_size, length))
+            self._pos = 0
+            if len (self._buf) < length:
+                raise eventLogError ('event log truncated')
+        _pos = self._pos
+        self._pos += length
+        return self._buf, _pos
+
+def read_event_log (fobj, chunk_size=EVENT_LOG_CHUNK_SIZE):
+    ''' tcgEvent for each event in a SHA-1 or crypto-agile TCG log '''
+    _reader = _chunkReader (fobj, chunk_size)
+    _sizes = None
+    _number = 0
+    while not _reader.at_eof ():
+        _buf, _pos = _reader.take (_EVENT_HEADER.size)
+        _pcr, _type = _EVENT_HEADER.unpack_from (_buf, _pos)
+        if _sizes is None:
+            _buf, _pos = _reader.take (_EVENT_SHA1_DIGEST.size)
+            _digest, _data_size = _EVENT_SHA1_DIGEST.unpack_from (_buf, _pos)
+            _digests = {'sha1' : _digest}
+        else:
+            _buf, _pos = _reader.take (_EVENT_UINT32.size)
+            _digests = dict ()
+            for _ in xrange (_EVENT_UINT32.unpack_from (_buf, _pos) [0]):
+                _buf, _pos = _reader.take (_EVENT_DIGEST_HEADER.size)
+                _alg_id = _EVENT_DIGEST_HEADER.unpack_from (_buf, _pos) [0]
+                if _alg_id not in _sizes:
+                    raise eventLogError ('event {0}: digest algorithm {1:#x} not in Spec ID event'.format (_number, _alg_id))
+                _buf, _pos = _reader.take (_sizes [_alg_id])
+                _digests [_TPM_ALG_NAMES.get (_alg_id, _alg_id)] = _buf [_pos : _pos + _sizes [_alg_id]]
+            _buf, _pos = _reader.take (_EVENT_UINT32.size)
+            _data_size = _EVENT_UINT32.unpack_from (_buf, _pos) [0]
+        _buf, _pos = _reader.take (_data_size)
+        _data = _buf [_pos : _pos + _data_size]
+        if _number == 0 and _type == EV_NO_ACTION and _data.startswith (_SPEC_ID_SIGNATURE):
+            # crypto-agile log, the Spec ID event lists the digest sizes
+            _count = _SPEC_ID_HEADER.unpack_from (_data) [-1]
+            _sizes = dict (_SPEC_ID_ALG.unpack_from (_data, _SPEC_ID_HEADER.size + _SPEC_ID_ALG.size * _index)
+                           for _index in xrange (_count))
+        yield tcgEvent (_number, _pcr, _type, _digests, _data)
+        _number += 1
+
+logDivergence = collections.namedtuple ('logDivergence', ('pcr', 'alg', 'event', 'extend', 'expected', 'logged'))
+
+def replay_event_log (fobj, predictions, chunk_size=EVENT_LOG_CHUNK_SIZE):
+    ''' returns ({pcr index: pcrEmu}, the first logDivergence or None) '''
+    _replayed = dict ((_pcr, pcrEmu (_pred.algs ())) for _pcr, _pred in predictions.iteritems ())
+    _expected = dict (((_pcr, _alg), list (_pred.log (_alg)))
+                      for _pcr, _pred in predictions.iteritems () for _alg in _pred.algs ())
+    _divergence = None
+    for _event in read_event_log (fobj, chunk_size):
+        if _event.pcr not in _replayed or _event.type == EV_NO_ACTION:
+            continue
+        _emu = _replayed [_event.pcr]
+        _extend = len (_emu)
+        if _divergence is None:
+            for _alg in _emu.algs ():
+                _log = _expected [(_event.pcr, _alg)]
+                _want = _log [_extend][1] if _extend < len (_log) else None
+                _have = _event.digests.get (_alg)
+                if _want != _have:
+                    _divergence = logDivergence (_event.pcr, _alg, _event.number, _extend, _want, _have)
+                    break
+        _emu.extend_many ((dict ((_alg, _digest) for _alg, _digest in _event.digests.iteritems () if _alg in _emu.algs ()),))
+    if _divergence is None:
+        for (_pcr, _alg), _log in sorted (_expected.iteritems ()):
+            _extend = len (_replayed [_pcr])
+            if _extend < len (_log):
+                _divergence = logDivergence (_pcr, _alg, None, _extend, _log [_extend][1], None)
+                break
+    return _replayed, _divergence
+
+def add_event_log_args (parser):
+    event_log_help = 'binary TCG event log to check the calculated extends against'
+    parser.add_argument ('--event-log', help=event_log_help)
+
+def check_event_log (path, pcr, prediction, outfile):
+    ''' True when the log at path replays to the predicted pcr '''
+    try:
+        with open (path, 'rb') as _fobj:
+            _replayed, _div = replay_event_log (_fobj, {pcr : prediction})
+    except (IOError, eventLogError) as e:
+        outfile.write ('event log {0}: {1}\n'.format (path, e))
+        return False
+    if _div is None:
+        outfile.write ('event log: PCR[{0}] matches after {1} extends\n'.format (pcr, len (_replayed [pcr])))
+        return True
+    _hex = dict ((_side, 'nothing' if _value is None else _value.encode ('hex'))
+                 for _side, _value in (('expected', _div.expected), ('logged', _div.logged)))
+    _where = 'end of log' if _div.event is None else 'event {0}'.format (_div.event)
+    outfile.write ('event log: PCR[{0}] {1} diverges at {2}, extend {3}: expected {4}, logged {5}\n'.format (
+        _div.pcr, _div.alg, _where, _div.extend, _hex ['expected'], _hex ['logged']))
+    return False
+
+class _hashFanout (object):
+    # a single update () feeding several hash objects, lets any one-pass
+    # reader hash for every bank at once
+    def __init__ (self, hashobjs):
+        self._updates = [_hash.update for _hash in hashobjs]
+    def update (self, data):
+        for _update in self._updates:
+            _update (data)
 
 class mleHeader (binParse):
     _UUID_OFFSET = 0
@@ -740,41 +1671,146 @@ class mleHeader (binParse):
     _CMDLINE_START_OFF_SIZE = 4
     _CMDLINE_END_OFF_OFFSET = _CMDLINE_START_OFF_OFFSET + _CMDLINE_START_OFF_SIZE
     _CMDLINE_END_OFF_SIZE = 4
+    _LAYOUT = recordLayout ('mleHeaderRecord', (
+        ('uuid', _UUID_SIZE, FIELD_BYTES),
+        ('length', _LENGTH_SIZE, FIELD_UINT),
+        ('version', _VERSION_SIZE, FIELD_UINT),
+        ('entry_point', _ENTRY_POINT_SIZE, FIELD_UINT),
+        ('first_valid_page', _FIRST_VALID_PAGE_SIZE, FIELD_UINT),
+        ('mle_start_off', _MLE_START_OFF_SIZE, FIELD_UINT),
+        ('mle_end_off', _MLE_END_OFF_SIZE, FIELD_UINT),
+        ('capabilities', _CAPABILITIES_SIZE, FIELD_UINT),
+        ('cmdline_start_off', _CMDLINE_START_OFF_SIZE, FIELD_UINT),
+        ('cmdline_end_off', _CMDLINE_END_OFF_SIZE, FIELD_UINT),
+        ))
+    # cmdlines whose hashes are kept, pcrd holds on to headers for long
+    _MAX_CMDLINES = 8
 
-    def __init__(self, pfile, pmmap=False, poffset=0, cmdline=''):
+    def __init__(self, pfile, pmmap=False, poffset=0, cmdline='', image=None):
         self._offset = poffset
-        self._cmdline = cmdline
-        super (mleHeader, self).__init__ (pfile, pfile)
+        self._cmdline = cmdline or ''
+        self._image = image
+        self._hashes = collections.OrderedDict ()
+        self._hashes_lock = threading.Lock ()
+        if image is not None:
+            # only the header itself is copied out of the loaded image
+            super (mleHeader, self).__init__ (None, image.read (poffset, self._LAYOUT.size))
+        else:
+            super (mleHeader, self).__init__ (pfile, pfile)
+            self._record_offset = poffset
     def uuid_bytes (self):
-        return self._read_bytes (self._offset + self._UUID_OFFSET, self._UUID_SIZE)
+        return bytearray (self._fields ().uuid)
     def uuid (self):
+        import uuid
         return uuid.UUID (bytes=str (self.uuid_bytes ()))
     def length (self):
-        return self._read_uint (self._offset + self._LENGTH_OFFSET, self._LENGTH_SIZE)
+        return self._fields ().length
     def version (self):
-        return self._read_uint (self._offset + self._VERSION_OFFSET, self._VERSION_SIZE)
+        return self._fields ().version
     def entry_point (self):
-        return self._read_uint (self._offset + self._ENTRY_POINT_OFFSET, self._ENTRY_POINT_SIZE)
+        return self._fields ().entry_point
     def first_valid_page (self):
-        return self._read_uint (self._offset + self._FIRST_VALID_PAGE_OFFSET, self._FIRST_VALID_PAGE_SIZE)
+        return self._fields ().first_valid_page
     def mle_start_off (self):
-        return self._read_uint (self._offset + self._MLE_START_OFF_OFFSET, self._MLE_START_OFF_SIZE)
+        return self._fields ().mle_start_off
     def mle_end_off (self):
-        return self._read_uint (self._offset + self._MLE_END_OFF_OFFSET, self._MLE_END_OFF_SIZE)
+        return self._fields ().mle_end_off
     def capabilities (self):
-        return self._read_uint (self._offset + self._CAPABILITIES_OFFSET, self._CAPABILITIES_SIZE)
+        return self._fields ().capabilities
     def cmdline_start_off (self):
-        return self._read_uint (self._offset + self._CMDLINE_START_OFF_OFFSET, self._CMDLINE_START_OFF_SIZE)
+        return self._fields ().cmdline_start_off
     def cmdline_end_off (self):
-        return self._read_uint (self._offset + self._CMDLINE_END_OFF_OFFSET, self._CMDLINE_END_OFF_SIZE)
-    def hash_sha1 (self):
-        for a in range (self.cmdline_start_off (), self.cmdline_end_off ()) :
-            self._filemmap [a] = '\x00'
-        for a in range (len (self._cmdline)) :
-            self._filemmap [self.cmdline_start_off () + a] = self._cmdline [a]
-        _sha1 = hashlib.sha1 ()
-        _sha1.update (self._filemmap [self.mle_start_off () : self.mle_end_off ()])
-        return _sha1
+        return self._fields ().cmdline_end_off
+    def _hash_range (self, hashobj, start, end):
+        if start >= end:
+            return
+        if self._image is not None:
+            self._image.hash_range (hashobj, start, end)
+        else:
+            hashobj.update (self._read_view (start, end - start))
+    def hashes (self, algs=('sha1',), cmdline=None):
+        ''' {algorithm: hash} of the MLE as tboot measures it with cmdline,
+        the most recently used cmdlines stay memoized '''
+        cmdline = str (self._cmdline if cmdline is None else cmdline)
+        with self._hashes_lock:
+            _memo = self._hashes.pop (cmdline, None) or dict ()
+            self._hashes [cmdline] = _memo
+            while len (self._hashes) > self._MAX_CMDLINES:
+                self._hashes.popitem (last=False)
+            _missing = [_alg for _alg in algs if _alg not in _memo]
+        if _missing:
+            _start = self.mle_start_off ()
+            _end = self.mle_end_off ()
+            _cmd_start = self.cmdline_start_off ()
+            _patch = cmdline.ljust (self.cmdline_end_off () - _cmd_start, '\x00')
+            _patch_start = min (max (_cmd_start, _start), _end)
+            _patch_end = min (max (_cmd_start + len (_patch), _start), _end)
+            _hashobjs = [hashlib.new (_alg) for _alg in _missing]
+            _hash = _hashFanout (_hashobjs)
+            with stage ('mle_hash') as _stage:
+                self._hash_range (_hash, _start, _patch_start)
+                _hash.update (buffer (_patch, _patch_start - _cmd_start, _patch_end - _patch_start))
+                self._hash_range (_hash, _patch_end, _end)
+                _stage.read = max (_end - _start, 0) - (_patch_end - _patch_start)
+                _stage.hashed = max (_end - _start, 0)
+            with self._hashes_lock:
+                _memo.update (zip (_missing, _hashobjs))
+        return dict ((_alg, _memo [_alg].copy ()) for _alg in algs)
+    def hash_sha1 (self, cmdline=None):
+        return self.hashes (('sha1',), cmdline) ['sha1']
+
+class loadedImage (object):
+    ''' the PT_LOAD segments of an ELF laid end to end, as tboot loads the MLE '''
+    _ZEROS = '\x00' * (64 * 1024)
+    def __init__ (self, source):
+        self._source = source
+        # (image offset, length, source offset or None for zero fill)
+        self._extents = []
+        self._size = 0
+        from elftools.elf.elffile import ELFFile
+        for segment in ELFFile (cStringIO.StringIO (source) if isinstance (source, str) else source).iter_segments ():
+            if segment ['p_type'] == 'PT_LOAD':
+                self._add_extent (segment ['p_filesz'], segment ['p_offset'])
+                self._add_extent (segment ['p_memsz'] - segment ['p_filesz'], None)
+    def _add_extent (self, length, src_offset):
+        if length <= 0:
+            return
+        if src_offset is not None and src_offset + length > len (self._source):
+            raise MLEError ('ELF segment at {0:#x} runs past the end of the file'.format (src_offset))
+        self._extents.append ((self._size, length, src_offset))
+        self._size += length
+    def __len__ (self):
+        return self._size
+    def find (self, sub):
+        for _start, _length, _src in self._extents:
+            if _src is None:
+                continue
+            _index = self._source.find (sub, _src, _src + _length)
+            if _index >= 0:
+                return _start + _index - _src
+        return -1
+    def _pieces (self, start, end):
+        # (source offset or None, length) for each extent overlapping the range
+        for _start, _length, _src in self._extents:
+            _lo = max (start, _start)
+            _hi = min (end, _start + _length)
+            if _lo >= _hi:
+                continue
+            yield (None if _src is None else _src + _lo - _start), _hi - _lo
+    def read (self, offset, length):
+        _parts = []
+        for _src, _length in self._pieces (offset, offset + length):
+            _parts.append ('\x00' * _length if _src is None else self._source [_src : _src + _length])
+        return ''.join (_parts)
+    def hash_range (self, hashobj, start, end):
+        for _src, _length in self._pieces (start, end):
+            if _src is not None:
+                hashobj.update (buffer (self._source, _src, _length))
+                continue
+            while _length > 0:
+                _count = min (_length, len (self._ZEROS))
+                hashobj.update (buffer (self._ZEROS, 0, _count))
+                _length -= _count
 
 class MLEError (Exception):
     def __init__ (self, message):
@@ -782,12 +1818,15 @@ class MLEError (Exception):
 
 class MLEUtil (object):
     _MLE_UUID_STR = '5aac8290-6f47-a774-0f5c-55a2cb51b642'
-    _MLE_UUID = uuid.UUID (_MLE_UUID_STR)
-    def __init__ (self, arg_str, mle_file_obj):
+    _MLE_UUID_BYTES = _MLE_UUID_STR.replace ('-', '').decode ('hex')
+    def __init__ (self, arg_str, mle_file_obj, cache=None):
         self._arg_str = arg_str
         self._mle_file_obj = mle_file_obj
+        self._cache = cache
+        self._mle_hdr = None
 
     def _open_gzip (self, fobj):
+        from gzip import GzipFile
         try:
             _gz = GzipFile (fileobj=fobj)
             # read will fail if fobj isn't a proper gzip
@@ -797,41 +1836,103 @@ class MLEUtil (object):
             _gz = None
         return _gz
 
-    def _extract_elf_mmap (self, fobj):
+    def _load_source (self):
+        # the ELF bytes: a read-only map of a plain file, or the whole
+        # stream inflated in memory when it is gzipped.  That trades the
+        # old temp-file copy for resident memory the size of the inflated
+        # ELF: GzipFile can't seek back cheaply and the MLE header search
+        # and the hash both need random access to the segments
+        with stage ('mle_gzip_probe'):
+            _gz = self._open_gzip (self._mle_file_obj)
+        if _gz is not None:
+            with stage ('mle_inflate') as _stage:
+                try:
+                    return _gz.read ()
+                except IOError as e:
+                    raise MLEError ('error decompressing ELF file {0}: {1}'.format (self._mle_file_obj.name, e))
+                finally:
+                    _gz.close ()
+                    _stage.read = self._mle_file_obj.tell ()
+        self._mle_file_obj.seek (0)
+        return mmap.mmap (self._mle_file_obj.fileno (), 0, access=mmap.ACCESS_READ)
+
+    def get_image (self):
+        from elftools.common.exceptions import ELFError
         try:
-            _mle_elf = ELFFile (fobj)
-            _tmp_file = tempfile.TemporaryFile ()
-            for segment in _mle_elf.iter_segments ():
-                if segment ['p_type'] is 'PT_LOAD':
-                    _p_offset = segment ['p_offset']
-                    _p_filesz = segment ['p_filesz']
-                    _p_memsz  = segment ['p_memsz']
-                    _elf_end = _p_offset + _p_filesz
-                    # copy segment
-                    _tmp_file.write (fobj [_p_offset : _elf_end])
-                    # 0 fill remaining area
-                    for a in range (_p_memsz - _p_filesz):
-                        _tmp_file.write ('\x00')
-            return mmap.mmap (_tmp_file.fileno (), 0, access=mmap.ACCESS_WRITE)
-        except IOError as e:
-            raise MLEError ('error decompressing ELF file {0}: {1}'.format (e.filename, e.strerror))
+            _source = self._load_source ()
+            # segments are only located here, their bytes are read when hashed
+            with stage ('mle_elf_load'):
+                return loadedImage (_source)
+        except ELFError as e:
+            raise MLEError ('error parsing ELF file {0}: {1}'.format (self._mle_file_obj.name, e))
 
     def get_mle_hdr (self):
-        _mle_file_obj = self._mle_file_obj
-        _gz = self._open_gzip (_mle_file_obj)
-        if _gz is not None:
-            _tmp_file = tempfile.TemporaryFile ()
-            _tmp_file.write (_gz.read ())
-            _gz.close ()
-            _mle_file_obj = _tmp_file
-        _mle_file_mmap = mmap.mmap (_mle_file_obj.fileno (), 0, access=mmap.ACCESS_COPY)
-        _elf_mmap = self._extract_elf_mmap (_mle_file_mmap)
-        _index = _elf_mmap.find (self._MLE_UUID.bytes)
-        if _index < 0:
-            raise MLEError ('Unable to find MLE in file: {0}.'.format (self._mle_file_obj.name))
-        return mleHeader (_elf_mmap, True, _index, self._arg_str)
-
-def hash_module (cmdline, fd_module):
+        if self._mle_hdr is None:
+            _image = self.get_image ()
+            _index = _image.find (self._MLE_UUID_BYTES)
+            if _index < 0:
+                raise MLEError ('Unable to find MLE in file: {0}.'.format (self._mle_file_obj.name))
+            self._mle_hdr = mleHeader (None, True, _index, self._arg_str, _image)
+        return self._mle_hdr
+
+    def hashes (self, algs=('sha1',)):
+        # consult the cache before decompressing or loading anything
+        _params = str (self._arg_str)
+        _hashes = dict ()
+        if self._cache is not None:
+            for _alg in algs:
+                _digest = self._cache.lookup (self._mle_file_obj, _alg, _params)
+                if _digest is not None:
+                    _hashes [_alg] = cachedDigest (_digest)
+        _missing = [_alg for _alg in algs if _alg not in _hashes]
+        if _missing:
+            _hashes.update (self.get_mle_hdr ().hashes (_missing))
+            if self._cache is not None:
+                for _alg in _missing:
+                    self._cache.store (self._mle_file_obj, _alg, _params, _hashes [_alg].digest ())
+        return _hashes
+
+    def hash_sha1 (self):
+        return self.hashes (('sha1',)) ['sha1']
+
+# default read size when streaming modules into a hash
+MODULE_CHUNK_SIZE = 1024 * 1024
+
+def _hash_file (hashobj, fobj, chunk_size=MODULE_CHUNK_SIZE):
+    # hash fobj from its current position to the end in bounded memory:
+    # regular files one mapped window at a time, anything else with
+    # readinto on a single reused buffer; returns the number of bytes
+    _ident = _file_identity (fobj)
+    if _ident is not None:
+        _size = _ident [2]
+        _window = max (chunk_size - chunk_size % mmap.ALLOCATIONGRANULARITY, mmap.ALLOCATIONGRANULARITY)
+        _pos = fobj.tell ()
+        _total = max (_size - _pos, 0)
+        while _pos < _size:
+            _base = _pos - _pos % mmap.ALLOCATIONGRANULARITY
+            _length = min (_window, _size - _base)
+            _map = mmap.mmap (fobj.fileno (), _length, access=mmap.ACCESS_READ, offset=_base)
+            try:
+                hashobj.update (buffer (_map, _pos - _base))
+            finally:
+                _map.close ()
+            _pos = _base + _length
+        fobj.seek (_size)
+        return _total
+    _buf = bytearray (chunk_size)
+    _total = 0
+    while True:
+        _count = fobj.readinto (_buf)
+        if not _count:
+            break
+        hashobj.update (buffer (_buf, 0, _count))
+        _total += _count
+    return _total
+
+def hash_module (cmdline, fd_module, cache=None, chunk_size=MODULE_CHUNK_SIZE):
+    return hash_module_banks (cmdline, fd_module, ('sha1',), cache, chunk_size) ['sha1']
+
+def hash_module_banks (cmdline, fd_module, algs, cache=None, chunk_size=MODULE_CHUNK_SIZE):
     '''  from tboot-1.7.3/tboot/common/policy.c
     cmdline is first stripped of leading spaces, file name, then
     any spaces until the next non-space char
@@ -842,15 +1943,240 @@ def hash_module (cmdline, fd_module):
     except ValueError:
         cmdline = ''
 
+    _hashes = dict ()
+    if cache is not None:
+        for _alg in algs:
+            _digest = cache.lookup (fd_module, _alg, cmdline)
+            if _digest is not None:
+                _hashes [_alg] = cachedDigest (_digest)
+    _missing = [_alg for _alg in algs if _alg not in _hashes]
+    if not _missing:
+        return _hashes
+
     ''' from tboot-1.7.3/tboot/common/policy.c
-    final hash is SHA-1( SHA-1(cmdline) | SHA-1(image) ) '''
-    cmd_hash = hashlib.sha1 ()
-    mod_hash = hashlib.sha1 ()
-    both_hash = hashlib.sha1 ()
-    cmd_hash.update (cmdline)
-    ''' assume module is small enough to cache, may need to hash in chunks
-    to accomodate larger modules'''
-    mod_hash.update (fd_module.read ())
-    both_hash.update (cmd_hash.digest ())
-    both_hash.update (mod_hash.digest ())
-    return both_hash
+    final hash is SHA-1( SHA-1(cmdline) | SHA-1(image) ), other banks
+    use their own algorithm throughout; the image is read once for all of them '''
+    mod_hashes = [hashlib.new (_alg) for _alg in _missing]
+    with stage ('module_hash') as _stage:
+        _stage.read = _hash_file (_hashFanout (mod_hashes), fd_module, chunk_size)
+        _stage.hashed = _stage.read + len (cmdline)
+    for _alg, mod_hash in zip (_missing, mod_hashes):
+        both_hash = hashlib.new (_alg, hashlib.new (_alg, cmdline).digest ())
+        both_hash.update (mod_hash.digest ())
+        if cache is not None:
+            cache.store (fd_module, _alg, cmdline, both_hash.digest ())
+        _hashes [_alg] = both_hash
+    return _hashes
+
+class cachedDigest (object):
+    ''' stands in for a finished hashlib object '''
+    def __init__ (self, digest):
+        self._digest = digest
+    def digest (self):
+        return self._digest
+    def hexdigest (self):
+        return self._digest.encode ('hex')
+    def copy (self):
+        return self
+
+def _file_identity (fobj):
+    # (device, inode, size, mtime in ns) of a regular file, None otherwise
+    try:
+        _st = os.fstat (fobj.fileno ())
+    except (AttributeError, OSError, ValueError):
+        return None
+    if not stat.S_ISREG (_st.st_mode):
+        return None
+    return (_st.st_dev, _st.st_ino, _st.st_size, int (_st.st_mtime * 1000000000))
+
+class measureCache (object):
+    ''' opt-in sqlite cache of measurements keyed by file identity, algorithm
+    and parameters, least recently used entries past max_entries evicted '''
+    ENV_VAR = 'PCR_CALC_CACHE'
+    MAX_ENTRIES = 100000
+    TOUCH_INTERVAL = 3600
+    _SCHEMA = (
+        '''CREATE TABLE IF NOT EXISTS measurements (
+            dev INTEGER, ino INTEGER, size INTEGER, mtime_ns INTEGER,
+            alg TEXT, params TEXT, digest BLOB, last_used REAL,
+            PRIMARY KEY (dev, ino, size, mtime_ns, alg, params))''',
+        '''CREATE INDEX IF NOT EXISTS measurements_lru
+            ON measurements (last_used)''',
+        )
+    _KEY = 'dev = ? AND ino = ? AND size = ? AND mtime_ns = ? AND alg = ? AND params = ?'
+    def __init__ (self, path, max_entries=MAX_ENTRIES, verify=0.0):
+        import sqlite3
+        self._db = sqlite3.connect (path, timeout=60, check_same_thread=False)
+        self._lock = threading.Lock ()
+        for _stmt in self._SCHEMA:
+            self._db.execute (_stmt)
+        self._db.commit ()
+        self._max_entries = max_entries
+        self._verify = verify
+        if verify:
+            import random
+            self._random = random.random
+        self._held = dict ()
+        self.stale = list ()
+    def lookup (self, fobj, alg, params=''):
+        _ident = _file_identity (fobj)
+        if _ident is None:
+            return None
+        _key = _ident + (alg, params)
+        with self._lock:
+            _row = self._db.execute ('SELECT digest, last_used FROM measurements WHERE ' + self._KEY, _key).fetchone ()
+            if _row is None:
+                return None
+            if self._verify and self._random () < self._verify:
+                # pretend to miss, the caller's store () checks the fresh hash
+                self._held [_key] = str (_row [0])
+                return None
+            _now = time.time ()
+            if _now - _row [1] > self.TOUCH_INTERVAL:
+                self._db.execute ('UPDATE measurements SET last_used = ? WHERE ' + self._KEY, (_now,) + _key)
+                self._db.commit ()
+        return str (_row [0])
+    def store (self, fobj, alg, params, digest):
+        _ident = _file_identity (fobj)
+        if _ident is None:
+            return
+        _key = _ident + (alg, params)
+        with self._lock:
+            _held = self._held.pop (_key, None)
+            if _held is not None and _held != digest:
+                self.stale.append (getattr (fobj, 'name', repr (fobj)))
+            self._db.execute ('INSERT OR REPLACE INTO measurements VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                              _key + (buffer (digest), time.time ()))
+            self._evict ()
+            self._db.commit ()
+    def _evict (self):
+        _count = self._db.execute ('SELECT COUNT(*) FROM measurements').fetchone () [0]
+        if _count > self._max_entries:
+            self._db.execute ('DELETE FROM measurements WHERE rowid IN (SELECT rowid FROM measurements ORDER BY last_used LIMIT ?)',
+                              (_count - self._max_entries,))
+    def close (self, errfile=None):
+        if errfile is not None:
+            for _name in self.stale:
+                errfile.write ('stale measurement cache entry for {0}, replaced\n'.format (_name))
+        self._db.close ()
+
+def add_cache_args (parser):
+    cache_help = 'sqlite file caching measurements, default ${0}'.format (measureCache.ENV_VAR)
+    no_cache_help = 'do not use the measurement cache'
+    verify_help = 're-hash this fraction of cache hits and replace stale entries (default 1.0)'
+    entries_help = 'number of measurements the cache keeps, least recently used evicted first (default {0})'.format (measureCache.MAX_ENTRIES)
+    parser.add_argument ('--cache', help=cache_help, default=os.environ.get (measureCache.ENV_VAR))
+    parser.add_argument ('--no-cache', help=no_cache_help, action='store_true')
+    parser.add_argument ('--verify-cache', help=verify_help, type=float, nargs='?', const=1.0, default=0.0)
+    parser.add_argument ('--cache-entries', help=entries_help, type=int, default=measureCache.MAX_ENTRIES)
+
+def open_cache (args):
+    if args.no_cache or not args.cache:
+        return None
+    return measureCache (args.cache, args.cache_entries, args.verify_cache)
+
+def parse_banks (string):
+    _algs = tuple (_alg.strip ().lower () for _alg in string.split (',') if _alg.strip ())
+    for _alg in _algs:
+        try:
+            hashlib.new (_alg)
+        except ValueError:
+            raise argparse.ArgumentTypeError ('unknown hash algorithm: {0}'.format (_alg))
+    if not _algs:
+        raise argparse.ArgumentTypeError ('at least one bank is needed')
+    return _algs
+
+def add_bank_args (parser):
+    banks_help = 'comma separated PCR banks to calculate, the first is shown in detail (default: sha1)'
+    parser.add_argument ('--banks', help=banks_help, type=parse_banks, default=('sha1',))
+
+# per stage instrumentation for --stats, nothing is timed or counted
+# until enable_stats () is called
+_STATS = None
+
+class stageStats (object):
+    ''' calls, time, bytes read and hashed and peak RSS per stage '''
+    def __init__ (self):
+        import resource
+        self._resource = resource
+        self._stages = collections.OrderedDict ()
+        self._lock = threading.Lock ()
+    def _peak_rss (self):
+        # ru_maxrss is in KiB on Linux
+        return self._resource.getrusage (self._resource.RUSAGE_SELF).ru_maxrss * 1024
+    def add (self, name, seconds, read=0, hashed=0):
+        _rss = self._peak_rss ()
+        with self._lock:
+            _stage = self._stages.get (name)
+            if _stage is None:
+                _stage = {'calls' : 0, 'seconds' : 0.0, 'bytes_read' : 0, 'bytes_hashed' : 0}
+                self._stages [name] = _stage
+            _stage ['calls'] += 1
+            _stage ['seconds'] += seconds
+            _stage ['bytes_read'] += read
+            _stage ['bytes_hashed'] += hashed
+            _stage ['peak_rss'] = _rss
+    def as_dict (self):
+        with self._lock:
+            return {'stages' : dict ((_name, dict (_stage)) for _name, _stage in self._stages.iteritems ()),
+                    'peak_rss' : self._peak_rss ()}
+
+class _stageTimer (object):
+    def __init__ (self, stats, name):
+        self._stats = stats
+        self._name = name
+        self.read = 0
+        self.hashed = 0
+    def __enter__ (self):
+        self._start = time.time ()
+        return self
+    def __exit__ (self, exc_type, exc_value, traceback):
+        self._stats.add (self._name, time.time () - self._start, self.read, self.hashed)
+        return False
+
+class _noStage (object):
+    # stands in for _stageTimer while stats are off; one instance is shared
+    # by every thread, so it holds no state and counts written to it drop
+    __slots__ = ()
+    def _zero (self):
+        return 0
+    def _drop (self, value):
+        pass
+    read = property (_zero, _drop)
+    hashed = property (_zero, _drop)
+    def __enter__ (self):
+        return self
+    def __exit__ (self, exc_type, exc_value, traceback):
+        return False
+
+_NO_STAGE = _noStage ()
+
+def stage (name):
+    ''' times one stage, add to its read and hashed attributes to count bytes '''
+    if _STATS is None:
+        return _NO_STAGE
+    return _stageTimer (_STATS, name)
+
+def enable_stats ():
+    global _STATS
+    if _STATS is None:
+        _STATS = stageStats ()
+    return _STATS
+
+def add_stats_args (parser):
+    stats_help = 'write time, bytes read and hashed and peak RSS per stage to stderr as JSON on exit'
+    parser.add_argument ('--stats', help=stats_help, action='store_true')
+
+def start_stats (args, outfile=None):
+    ''' with --stats, write every stage's totals to outfile on exit '''
+    if not args.stats:
+        return None
+    import atexit
+    import json
+    _stats = enable_stats ()
+    def _report ():
+        _out = outfile or sys.stderr
+        _out.write (json.dumps (_stats.as_dict (), sort_keys=True) + '\n')
+        _out.flush ()
+    atexit.register (_report)
+    return _stats
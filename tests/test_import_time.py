@@ -0,0 +1,59 @@
+#
+# Copyright 2013 Philip Tricca <flihp@twobit.us>
+#
+# start-up budget of the tools that never touch an ELF: importing txt
+# must not load the modules only the MLE path and a few others need
+
+import compileall
+import os
+import subprocess
+import sys
+import time
+import unittest
+
+PCR_CALC_DIR = os.path.join (os.path.dirname (os.path.abspath (__file__)), os.pardir, 'pcr-calc')
+# modules txt only imports in the functions using them
+DEFERRED = ('elftools', 'gzip', 'tempfile', 'uuid', 'datetime', 'random', 'multiprocessing', 'sqlite3')
+# every script imports txt, only pcr17, pcr18, pcr19, mlehash, pcrd and
+# acm-match also import pcrd or acmlib
+SCRIPT_MODULES = ('txt', 'pcrd', 'acmlib')
+# seconds importing all of them may add to a bare interpreter start,
+# measured at about 0.03 against 0.065 with elftools imported eagerly
+IMPORT_BUDGET = 0.045
+RUNS = 5
+
+def run_python (code):
+    _env = dict (os.environ, PYTHONPATH=PCR_CALC_DIR)
+    return subprocess.check_output ([sys.executable, '-c', code], env=_env)
+
+def best_time (code):
+    _best = None
+    for _run in xrange (RUNS):
+        _start = time.time ()
+        run_python (code)
+        _elapsed = time.time () - _start
+        _best = _elapsed if _best is None else min (_best, _elapsed)
+    return _best
+
+def loaded (imports, names):
+    _code = 'import sys\nimport {0}\nprint " ".join (n for n in {1!r} if n in sys.modules)'.format (', '.join (imports), names)
+    return run_python (_code).split ()
+
+class importTimeTest (unittest.TestCase):
+    @classmethod
+    def setUpClass (cls):
+        # time the imports, not compiling the sources
+        compileall.compile_dir (PCR_CALC_DIR, quiet=1)
+    def test_txt_defers_imports (self):
+        self.assertEqual (loaded (('txt',), DEFERRED), [])
+    def test_scripts_defer_imports (self):
+        self.assertEqual (loaded (SCRIPT_MODULES, DEFERRED), [])
+    def test_scripts_import_budget (self):
+        _bare = best_time ('pass')
+        _scripts = best_time ('import ' + ', '.join (SCRIPT_MODULES))
+        self.assertLess (_scripts - _bare, IMPORT_BUDGET,
+                         'importing {0} takes {1:.3f}s over a bare interpreter, budget {2}s'.format (
+                             ', '.join (SCRIPT_MODULES), _scripts - _bare, IMPORT_BUDGET))
+
+if __name__ == '__main__':
+    unittest.main ()